@@ -0,0 +1,2 @@
+-- All versions of all Trac wiki pages to convert from a Trac 0.11 / PostgreSQL DB
+select    name,    version,    time,    author,    text,    comment from    wiki order    by name, version
@@ -14,6 +14,11 @@ Upload release to PyPI::
   $ python test/test_tratihubis.py
   $ python setup.py sdist --formats=zip upload
 
+Record the Github requests of the tests again after changing them (needs the credentials in
+``~/.tratihubis_test``)::
+
+  $ TRATIHUBIS_CASSETTES=record python test/test_tratihubis.py
+
 Tag a release::
 
   $ git tag -a -m 'Tagged version 1.x.' v1.x
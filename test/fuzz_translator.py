@@ -0,0 +1,111 @@
+'''
+Fuzz and benchmark harness for the rules converting Trac wiki markup to Github markdown.
+
+It applies each rule to adversarial texts of growing size and reports rules whose time grows clearly faster
+than the size of the text, which hints at catastrophic backtracking. To run it::
+
+  $ python test/fuzz_translator.py
+
+Besides the adversarial texts, random Trac markup is translated to make sure no rule fails on odd input.
+'''
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import translator
+
+# Fragments that repeated many times provoke backtracking in at least some of the rules.
+ADVERSARIAL_FRAGMENTS = [
+    ('unclosed bold', u"'''x "),
+    ('unclosed italic', u"''x "),
+    ('unclosed code', u"{{{ x "),
+    ('unclosed heading', u"= x "),
+    ('unclosed link', u"[aaaaaaaaaaaaaaaaaaaa"),
+    ('apache log', u"[Mon Jan 05 12:00:00 2015] [error] [client 10.0.0.1] File does not exist: /var/www/x\n"),
+    ('hashes', u" 0123456789abcdef0123456789abcdef"),
+    ('hex digits', u"abcdef0123" * 3),
+    ('definitions', u" word::"),
+    ('superscripts', u"^1"),
+    ('wiki escapes', u"!WikiWord!x"),
+]
+
+# Fragments of more or less valid Trac markup for random texts.
+MARKUP_FRAGMENTS = [
+    u"{{{", u"}}}", u"\n", u"#!python\n", u"= Heading =\n", u"== Heading ==\n", u"'''bold'''", u"''italic''",
+    u" * item\n", u"!WikiWord", u" 0123456789abcdef0123 ", u"source:trunk/setup.py", u"blog:post", u" term::\n",
+    u"^2^", u"diff:@1:2", u"[http://example.com text]", u"[[Image(a.png)]]", u"attachment:log.txt", u"ticket:1",
+    u"[ticket:1]", u" ", u"text", u"'", u"[", u"]", u"(", u")", u"!", u":", u"=", u"\xe4",
+]
+
+
+def adversarialMarkup(fragment, size):
+    '''
+    Text of roughly ``size`` characters made of ``fragment``.
+    '''
+    return fragment * max(1, size // len(fragment))
+
+
+def randomMarkup(randomGenerator, fragmentCount):
+    return u''.join(randomGenerator.choice(MARKUP_FRAGMENTS) for _ in range(fragmentCount))
+
+
+def ruleSeconds(markupTranslator, text):
+    '''
+    Map of each rule pattern to the seconds it takes to apply it to ``text``.
+    '''
+    result = {}
+    for pattern, replacement, _ in markupTranslator.subs:
+        startTime = time.time()
+        pattern.sub(replacement, text)
+        result[pattern.pattern] = time.time() - startTime
+    return result
+
+
+def superLinearRules(markupTranslator, baseSize=2000, factor=4, minimumSeconds=0.05):
+    '''
+    List of ``(fragmentName, pattern, seconds, growth)`` for rules whose time grows more than twice as fast
+    as the size of an adversarial text when multiplying its size by ``factor``. Rules taking less than
+    ``minimumSeconds`` for the larger text are ignored to avoid noise.
+    '''
+    result = []
+    for fragmentName, fragment in ADVERSARIAL_FRAGMENTS:
+        smallSeconds = ruleSeconds(markupTranslator, adversarialMarkup(fragment, baseSize))
+        largeSeconds = ruleSeconds(markupTranslator, adversarialMarkup(fragment, baseSize * factor))
+        for pattern, seconds in largeSeconds.items():
+            growth = seconds / max(smallSeconds[pattern], 1e-6)
+            if (seconds >= minimumSeconds) and (growth > 2 * factor):
+                result.append((fragmentName, pattern, seconds, growth))
+    return result
+
+
+def fuzz(markupTranslator, textCount=1000, seed=0):
+    '''
+    Translate ``textCount`` random texts, raising the first error found together with the text causing it.
+    '''
+    randomGenerator = random.Random(seed)
+    for _ in range(textCount):
+        text = randomMarkup(randomGenerator, randomGenerator.randint(0, 30))
+        try:
+            markupTranslator.translate(text, ticketId=1)
+        except Exception, error:
+            raise AssertionError(u'cannot translate %r: %s' % (text, error))
+
+
+def main():
+    markupTranslator = translator.Translator('https://github.com/me/mytool', {1: 1}, trac_url='http://trac',
+            attachmentsPrefix='http://trac/raw-attachment/ticket')
+    fuzz(markupTranslator)
+    print 'translated random markup without errors'
+    rules = superLinearRules(markupTranslator)
+    for fragmentName, pattern, seconds, growth in sorted(rules, key=lambda rule: rule[2], reverse=True):
+        print '%7.3fs (%5.1fx) %-16s %s' % (seconds, growth, fragmentName, pattern)
+    if not rules:
+        print 'no super-linear rules found'
+    return 1 if rules else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+'''
+Record and replay of the HTTP requests PyGithub sends to Github, so tests that talk to Github can run
+offline and fast.
+
+A cassette is a JSON file holding the request/response pairs of one test. The mode is set by the
+environment variable ``TRATIHUBIS_CASSETTES``:
+
+* ``replay`` (the default): serve responses from the cassette if one exists; tests without a cassette
+  connect to Github.
+* ``record``: connect to Github and write every request/response pair to the cassette of the test.
+* ``live``: ignore cassettes and always connect to Github.
+
+To simulate the network while replaying, set ``TRATIHUBIS_CASSETTE_LATENCY`` to the seconds each request
+should take, or to ``recorded`` to take as long as it did while recording.
+
+A replayed test fails if it sends a request the cassette does not contain or leaves recorded requests
+unused, so additional API calls show up as regressions. It also fails if several threads send requests
+through the same connection at once, which PyGithub does not support. It also fails if its local processing, meaning
+the elapsed time without the simulated latency, exceeds the ``maxSeconds`` of the cassette.
+'''
+import json
+import os.path
+import threading
+import time
+
+import github.Requester
+
+MODE_LIVE = 'live'
+MODE_RECORD = 'record'
+MODE_REPLAY = 'replay'
+_MODES = (MODE_LIVE, MODE_RECORD, MODE_REPLAY)
+
+LATENCY_RECORDED = 'recorded'
+
+# Lower bound for ``maxSeconds`` when recording so that slow test machines do not cause failures.
+_MIN_MAX_SECONDS = 1.0
+_MAX_SECONDS_FACTOR = 3
+
+
+class CassetteError(Exception):
+    pass
+
+
+def modeFromEnvironment():
+    result = os.environ.get('TRATIHUBIS_CASSETTES', MODE_REPLAY).strip().lower()
+    if result not in _MODES:
+        raise CassetteError(u'TRATIHUBIS_CASSETTES is %r but must be one of: %s' % (result, ', '.join(_MODES)))
+    return result
+
+
+def latencyFromEnvironment():
+    '''
+    Seconds to wait for each replayed request, ``LATENCY_RECORDED`` or ``None`` for no latency.
+    '''
+    result = os.environ.get('TRATIHUBIS_CASSETTE_LATENCY', '').strip().lower()
+    if result == '':
+        result = None
+    elif result != LATENCY_RECORDED:
+        try:
+            result = float(result)
+        except ValueError:
+            raise CassetteError(u'TRATIHUBIS_CASSETTE_LATENCY is %r but must be a number of seconds or %r'
+                    % (result, LATENCY_RECORDED))
+    return result
+
+
+class _Response(object):
+    '''
+    Response with the parts of ``httplib.HTTPResponse`` PyGithub uses.
+    '''
+    def __init__(self, status, headers, body):
+        self.status = status
+        self._headers = headers
+        self._body = body
+
+    def getheaders(self):
+        return self._headers.items()
+
+    def read(self):
+        return self._body
+
+
+class Cassette(object):
+    '''
+    Request/response pairs stored in the JSON file ``path`` that are either recorded or replayed depending
+    on ``mode``. Use `start()` and `stop()` to route the requests of PyGithub through the cassette.
+    '''
+    def __init__(self, path, mode=MODE_REPLAY, latency=None):
+        assert mode in (MODE_RECORD, MODE_REPLAY), mode
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.interactions = []
+        self.maxSeconds = None
+        self.requestCount = 0
+        self.simulatedSeconds = 0.0
+        self._usedInteractionIndices = set()
+        self._lock = threading.Lock()
+        self._startTime = None
+        self.elapsedSeconds = None
+        if mode == MODE_REPLAY:
+            with open(path, 'rb') as cassetteFile:
+                data = json.load(cassetteFile)
+            self.interactions = data['interactions']
+            self.maxSeconds = data.get('maxSeconds')
+
+    def start(self):
+        cassette = self
+        if self.mode == MODE_RECORD:
+            class _CassetteHttpConnection(_RecordingConnection):
+                def __init__(self, host, port=None, **keywords):
+                    super(_CassetteHttpConnection, self).__init__(cassette,
+                            github.Requester.HTTPRequestsConnectionClass(host, port, **keywords))
+
+            class _CassetteHttpsConnection(_RecordingConnection):
+                def __init__(self, host, port=None, **keywords):
+                    super(_CassetteHttpsConnection, self).__init__(cassette,
+                            github.Requester.HTTPSRequestsConnectionClass(host, port, **keywords))
+        else:
+            class _CassetteHttpConnection(_ReplayingConnection):
+                def __init__(self, host, port=None, **keywords):
+                    super(_CassetteHttpConnection, self).__init__(cassette)
+            _CassetteHttpsConnection = _CassetteHttpConnection
+        github.Requester.Requester.injectConnectionClasses(_CassetteHttpConnection, _CassetteHttpsConnection)
+        # Injecting connection classes disables reusing connections; keep reusing them like PyGithub does by
+        # default, so tests notice threads sharing a connection.
+        github.Requester.Requester._Requester__persist = True
+        self._startTime = time.time()
+
+    def stop(self):
+        '''
+        Stop routing requests through the cassette and, when recording, write it to ``path``. Further calls
+        have no effect.
+        '''
+        if self.elapsedSeconds is not None:
+            return
+        github.Requester.Requester.resetConnectionClasses()
+        self.elapsedSeconds = time.time() - self._startTime
+        if self.mode == MODE_RECORD:
+            requestSeconds = sum(interaction['seconds'] for interaction in self.interactions)
+            localSeconds = max(0.0, self.elapsedSeconds - requestSeconds)
+            self.maxSeconds = round(max(_MIN_MAX_SECONDS, _MAX_SECONDS_FACTOR * localSeconds), 1)
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(self.path, 'wb') as cassetteFile:
+                json.dump({'maxSeconds': self.maxSeconds, 'interactions': self.interactions}, cassetteFile,
+                        indent=2, sort_keys=True)
+
+    @property
+    def localSeconds(self):
+        '''
+        Seconds elapsed between `start()` and `stop()` without the simulated latency.
+        '''
+        assert self.elapsedSeconds is not None
+        return self.elapsedSeconds - self.simulatedSeconds
+
+    def unusedInteractions(self):
+        return [interaction for index, interaction in enumerate(self.interactions)
+                if index not in self._usedInteractionIndices]
+
+    def _record(self, verb, url, status, headers, body, seconds):
+        with self._lock:
+            self.requestCount += 1
+            self.interactions.append({
+                'method': verb,
+                'url': url,
+                'status': status,
+                'headers': headers,
+                'body': body,
+                'seconds': round(seconds, 3),
+            })
+
+    def _replay(self, verb, url):
+        '''
+        The response of the first unused interaction matching ``verb`` and ``url``.
+        '''
+        with self._lock:
+            self.requestCount += 1
+            for index, interaction in enumerate(self.interactions):
+                if (index not in self._usedInteractionIndices) and (interaction['method'] == verb) \
+                        and (interaction['url'] == url):
+                    self._usedInteractionIndices.add(index)
+                    break
+            else:
+                raise CassetteError(u'%s: no recorded response for request #%d: %s %s'
+                        % (self.path, self.requestCount, verb, url))
+            if self.latency == LATENCY_RECORDED:
+                latency = interaction.get('seconds', 0.0)
+            else:
+                latency = self.latency or 0.0
+            self.simulatedSeconds += latency
+        if latency:
+            time.sleep(latency)
+        return _Response(interaction['status'], interaction['headers'], interaction['body'].encode('utf-8'))
+
+
+class _RecordingConnection(object):
+    '''
+    Connection passing requests to a real ``connection`` and recording them in ``cassette``.
+    '''
+    def __init__(self, cassette, connection):
+        self._cassette = cassette
+        self._connection = connection
+        self._verb = None
+        self._url = None
+
+    def request(self, verb, url, input, headers):
+        self._verb = verb
+        self._url = url
+        self._connection.request(verb, url, input, headers)
+
+    def getresponse(self):
+        startTime = time.time()
+        response = self._connection.getresponse()
+        body = response.read()
+        seconds = time.time() - startTime
+        headers = dict(response.getheaders())
+        self._cassette._record(self._verb, self._url, response.status, headers, body.decode('utf-8'), seconds)
+        return _Response(response.status, headers, body)
+
+    def close(self):
+        self._connection.close()
+
+
+class _ReplayingConnection(object):
+    '''
+    Connection serving responses from ``cassette`` without any network access.
+    '''
+    def __init__(self, cassette):
+        self._cassette = cassette
+        self._verb = None
+        self._url = None
+
+    def request(self, verb, url, input, headers):
+        if self._url is not None:
+            # A real connection would now send the URL of this request for the pending one too.
+            raise CassetteError(u'%s: request %s %s must wait for the response to pending request %s %s '
+                    u'on the same connection' % (self._cassette.path, verb, url, self._verb, self._url))
+        self._verb = verb
+        self._url = url
+
+    def getresponse(self):
+        try:
+            return self._cassette._replay(self._verb, self._url)
+        finally:
+            self._verb = None
+            self._url = None
+
+    def close(self):
+        pass
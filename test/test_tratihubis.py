@@ -27,33 +27,102 @@ Tests for tratihubis.
 # CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
+import bz2
+import collections
+import contextlib
 import ConfigParser
+import csv
+import datetime
 import github
+import gzip
+import json
 import logging
 import os.path
+import pickle
+import shutil
+import sqlite3
+import StringIO
+import subprocess
+import tarfile
+import tempfile
+import time
 import unittest
+import zlib
 
+import fuzz_translator
+import github_cassette
 import tratihubis
+import translator
 
 _TEST_CONFIG_PATHS = [
     os.path.expanduser(os.path.join('~', '.tratihubis_test')),
     os.path.expanduser(os.path.join('~', 'tratihubis_test.cfg'))
 ]
+_TEST_FOLDER = os.path.dirname(os.path.abspath(__file__))
+_CASSETTES_FOLDER = os.path.join(_TEST_FOLDER, 'cassettes')
 
 
 class _HubbedTest(unittest.TestCase):
     '''
     Like `unittest.TestCase` but with a `setUp()` that connects to Github and offers a ``hub`` property.
+
+    If the test has a cassette in ``test/cassettes``, the requests to Github are replayed from it instead,
+    see `github_cassette` for details.
     '''
     def setUp(self):
-        config = ConfigParser.SafeConfigParser()
-        config.read(_TEST_CONFIG_PATHS)
-        if not config.has_section('tratihubis'):
-            raise ConfigParser.Error(u'test user and password must be specified in section [tratihubis] '
-                    + 'in one of the following files: %s' % _TEST_CONFIG_PATHS)
-        password = config.get('tratihubis', 'password')
-        user = config.get('tratihubis', 'user')
-        self.hub = github.Github(user, password)
+        tratihubis._defaultSession = tratihubis.MigrationSession()
+        self.cassette = None
+        cassetteMode = github_cassette.modeFromEnvironment()
+        cassettePath = self._existingCassettePath() if cassetteMode == github_cassette.MODE_REPLAY else None
+        # PyGithub picks the connection class when creating the hub, so the cassette has to start first.
+        if cassettePath is not None:
+            self.cassette = github_cassette.Cassette(cassettePath, github_cassette.MODE_REPLAY,
+                    github_cassette.latencyFromEnvironment())
+            self.cassette.start()
+            self.addCleanup(self.cassette.stop)
+            self.hub = github.Github()
+        else:
+            config = ConfigParser.SafeConfigParser()
+            config.read(_TEST_CONFIG_PATHS)
+            if not config.has_section('tratihubis'):
+                raise ConfigParser.Error(u'test user and password must be specified in section [tratihubis] '
+                        + 'in one of the following files: %s' % _TEST_CONFIG_PATHS)
+            password = config.get('tratihubis', 'password')
+            user = config.get('tratihubis', 'user')
+            if cassetteMode == github_cassette.MODE_RECORD:
+                self.cassette = github_cassette.Cassette(self._cassettePaths()[0], github_cassette.MODE_RECORD)
+                self.cassette.start()
+                self.addCleanup(self.cassette.stop)
+            self.hub = github.Github(user, password)
+
+    def tearDown(self):
+        if self.cassette is not None:
+            self.cassette.stop()
+            if self.cassette.mode == github_cassette.MODE_REPLAY:
+                unusedInteractions = self.cassette.unusedInteractions()
+                self.assertEqual(unusedInteractions, [], u'%d recorded requests were not sent: %s' % (
+                        len(unusedInteractions),
+                        ', '.join('%s %s' % (interaction['method'], interaction['url'])
+                                for interaction in unusedInteractions)))
+                if self.cassette.maxSeconds is not None:
+                    self.assertLessEqual(self.cassette.localSeconds, self.cassette.maxSeconds)
+
+    def _cassettePaths(self):
+        '''
+        Paths of the cassettes for this test in the order they are looked for: one for the test method and
+        one shared by all tests of the class.
+        '''
+        className = self.__class__.__name__
+        return [
+            os.path.join(_CASSETTES_FOLDER, '%s.%s.json' % (className, self._testMethodName)),
+            os.path.join(_CASSETTES_FOLDER, '%s.json' % className),
+        ]
+
+    def _existingCassettePath(self):
+        for path in self._cassettePaths():
+            if os.path.exists(path):
+                return path
+        return None
 
 
 class _RepoedTest(_HubbedTest):
@@ -94,33 +163,1199 @@ class LabelTransformationTest(_RepoedTest):
 
 class UserMapTest(_HubbedTest):
     def testCanCreateValidUserMap(self):
-        userMap = tratihubis._createTracToGithubUserMap(self.hub, 'hugo: sepp, *: roskakori')
+        userMap = tratihubis._createTracToGithubUserMap(self.hub, 'hugo: sepp, *: roskakori', 'roskakori')
         self.assertEqual(userMap, {'*': 'roskakori', 'hugo': 'sepp'})
-        userMap = tratihubis._createTracToGithubUserMap(self.hub, '*:*')
-        self.assertEqual(userMap, {'*': '*'})
-        userMap = tratihubis._createTracToGithubUserMap(self.hub, ' * : * ')
-        self.assertEqual(userMap, {'*': '*'})
+        userMap = tratihubis._createTracToGithubUserMap(self.hub, '*:*', 'roskakori')
+        self.assertEqual(userMap, {'*': 'roskakori'})
+        userMap = tratihubis._createTracToGithubUserMap(self.hub, ' * : * ', 'roskakori')
+        self.assertEqual(userMap, {'*': 'roskakori'})
 
     def testFailsOnDuplicateUser(self):
         self.assertRaises(tratihubis._ConfigError, tratihubis._createTracToGithubUserMap,
-                self.hub, 'hugo: sepp, hugo: resi')
+                self.hub, 'hugo: sepp, hugo: resi', 'roskakori')
 
 
 class TratihubisTest(_RepoedTest):
+    def setUp(self):
+        super(TratihubisTest, self).setUp()
+        tratihubis._setUpdate(False)
+
     def _testCanConvertTicketsCsv(self, ticketsCsvPath, commentsCsvPath=None):
         labelMapping = 'type=defect: bug, type=enhancement: enhancement, resolution=wontfix: wontfix'
         userMapping = 'johndoe: roskakori, *: roskakori'
-        tratihubis.migrateTickets(self.hub, self.repo, ticketsCsvPath, commentsCsvPath,
+        tratihubis.migrateTickets(self.hub, self.repo, 'roskakori', ticketsCsvPath, commentsCsvPath,
                 userMapping=userMapping, labelMapping=labelMapping, pretend=True)
 
     def testCanConvertTestTicketsCsv(self):
         self._testCanConvertTicketsCsv(
-                os.path.join('test', 'test_tickets.csv'),
-                os.path.join('test', 'test_comments.csv')
+                os.path.join(_TEST_FOLDER, 'test_tickets.csv'),
+                os.path.join(_TEST_FOLDER, 'test_comments.csv')
         )
 
     def testCanConvertCutplaceTicketsCsv(self):
-        self._testCanConvertTicketsCsv(os.path.join('test', 'cutplace_tickets.csv'))
+        self._testCanConvertTicketsCsv(os.path.join(_TEST_FOLDER, 'cutplace_tickets.csv'))
+
+
+class _TempFolderTest(unittest.TestCase):
+    '''
+    Like `unittest.TestCase` but with a `setUp()` that creates a temporary folder available as ``tempFolder``
+    and removed again by `tearDown()`.
+    '''
+    def setUp(self):
+        self.tempFolder = tempfile.mkdtemp(prefix='tratihubis_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempFolder)
+
+
+class EventLogTest(_TempFolderTest):
+    def testCanWriteAndReadEvents(self):
+        eventLogPath = os.path.join(self.tempFolder, 'events.jsonl')
+        eventLog = tratihubis._EventLog(eventLogPath)
+        eventLog.log('issue_created', ticket=1, issue=3)
+        eventLog.log('comment_created', ticket=1, issue=3, comment=17, date=datetime.datetime(2015, 5, 1, 12, 0))
+        eventLog.close()
+        events = list(tratihubis._readEventLog(eventLogPath))
+        self.assertEqual([event['event'] for event in events], ['issue_created', 'comment_created'])
+        self.assertEqual(events[0]['issue'], 3)
+        self.assertEqual(events[1]['date'], '2015-05-01T12:00:00')
+
+    def testCanAppendToExistingLog(self):
+        eventLogPath = os.path.join(self.tempFolder, 'events.jsonl')
+        for ticketId in (1, 2):
+            eventLog = tratihubis._EventLog(eventLogPath)
+            eventLog.log('ticket_converted', ticket=ticketId)
+            eventLog.close()
+        self.assertEqual([event['ticket'] for event in tratihubis._readEventLog(eventLogPath)], [1, 2])
+
+
+class SyncStateTest(_TempFolderTest):
+    def testCanUpdateSyncState(self):
+        syncStatePath = os.path.join(self.tempFolder, 'sync.json')
+        self.assertEqual(tratihubis._readSyncState(syncStatePath), None)
+        ticketMaps = [
+            {'id': 1, 'modifiedtime': datetime.datetime(2015, 5, 1, 12, 0)},
+            {'id': 2, 'modifiedtime': datetime.datetime(2015, 5, 2, 12, 0)},
+        ]
+        ticketToCommentsMap = {1: [{'id': 1, 'date': datetime.datetime(2015, 5, 3, 12, 0)}]}
+        tratihubis._updateSyncState(syncStatePath, ticketMaps, ticketToCommentsMap, {1: 7, 2: 8})
+        syncState = tratihubis._readSyncState(syncStatePath)
+        self.assertEqual(syncState['tickets'], {1: 7, 2: 8})
+        self.assertEqual(syncState['highWaterMark'], tratihubis._timestamp(datetime.datetime(2015, 5, 3, 12, 0)))
+
+        tratihubis._updateSyncState(syncStatePath, [{'id': 3, 'modifiedtime': datetime.datetime(2015, 6, 1)}], {}, {3: 9})
+        syncState = tratihubis._readSyncState(syncStatePath)
+        self.assertEqual(syncState['tickets'], {1: 7, 2: 8, 3: 9})
+        self.assertEqual(syncState['highWaterMark'], tratihubis._timestamp(datetime.datetime(2015, 5, 3, 12, 0)))
+        self.assertEqual(syncState['synced'], {3: tratihubis._timestamp(datetime.datetime(2015, 6, 1))})
+
+
+class _FakeSyncedIssue(object):
+    def __init__(self, number, failingCommentCount=None):
+        self.number = number
+        self.labels = []
+        self.state = 'open'
+        self.commentBodies = []
+        self._failingCommentCount = failingCommentCount
+
+    def create_comment(self, body):
+        if len(self.commentBodies) == self._failingCommentCount:
+            raise github.GithubException(422, {'message': 'Validation Failed'})
+        self.commentBodies.append(body)
+        return _FakeObject(id=len(self.commentBodies))
+
+    def get_comments(self, since=None):
+        return []
+
+
+class SyncTest(_TempFolderTest):
+    def setUp(self):
+        super(SyncTest, self).setUp()
+        tratihubis._defaultSession = tratihubis.MigrationSession()
+        tratihubis._setUpdate(False)
+        self.ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2])
+        self.commentsCsvPath = os.path.join(self.tempFolder, 'comments.csv')
+        with open(self.commentsCsvPath, 'wb') as commentsCsvFile:
+            commentsCsvFile.write('ticket,time,author,newvalue\r\n'
+                                  '1,1425000000,alice,Imported.\r\n'
+                                  '1,1440000000,alice,See attachment:foo.txt.\r\n'
+                                  '2,1440000000,alice,Synced later.\r\n')
+        self.syncStatePath = os.path.join(self.tempFolder, 'sync.json')
+        tratihubis._writeSyncState(self.syncStatePath, 1435000000, {1: 5, 2: 6})
+
+    def _sync(self, issues):
+        repo = _FakeObject(full_name='me/mytool', name='mytool', owner=_FakeObject(login='me'),
+                           get_issue=lambda issueNumber: issues[issueNumber])
+        hub = _FakeObject(get_user=lambda: _FakeObject(login='me'), get_repo=lambda _: repo)
+        tratihubis._session().hubs['token'] = hub
+        tratihubis.syncTickets(hub, repo, 'token', self.ticketsCsvPath, self.syncStatePath,
+                               commentsCsvPath=self.commentsCsvPath, convert_text=True,
+                               attachmentsPrefix='https://example.com/attachments', pretend=False, retries=0)
+
+    def testCanSyncCommentsWithAttachmentLinks(self):
+        issues = {5: _FakeSyncedIssue(5), 6: _FakeSyncedIssue(6)}
+        self._sync(issues)
+        self.assertEqual(len(issues[5].commentBodies), 1)
+        self.assertTrue('https://example.com/attachments/1/foo.txt' in issues[5].commentBodies[0])
+        self.assertEqual(len(issues[6].commentBodies), 1)
+        syncState = tratihubis._readSyncState(self.syncStatePath)
+        self.assertEqual(syncState['highWaterMark'], 1440000000)
+        self.assertEqual(syncState['synced'], {})
+
+    def testCanSyncTicketsImportedBeforeLaterImport(self):
+        os.remove(self.syncStatePath)
+        importedTicketMaps = list(tratihubis._tracTicketMaps(self.ticketsCsvPath))
+        importedComments = {1: [{'date': datetime.datetime.fromtimestamp(1425000000)}]}
+        tratihubis._updateSyncState(self.syncStatePath, importedTicketMaps, importedComments, {1: 5, 2: 6})
+        # Ticket 3 is imported after the comment on ticket 1 has been written.
+        tratihubis._updateSyncState(self.syncStatePath,
+                [{'id': 3, 'modifiedtime': datetime.datetime.fromtimestamp(1445000000)}], {}, {3: 7})
+        issues = {5: _FakeSyncedIssue(5), 6: _FakeSyncedIssue(6)}
+        self._sync(issues)
+        self.assertEqual(len(issues[5].commentBodies), 1)
+        self.assertTrue(u'See ' in issues[5].commentBodies[0])
+        self.assertEqual(tratihubis._readSyncState(self.syncStatePath)['highWaterMark'], 1445000000)
+
+    def testCanSyncReferencesToTicketsNotImportedYet(self):
+        self.ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2, 3])
+        with open(self.commentsCsvPath, 'wb') as commentsCsvFile:
+            commentsCsvFile.write('ticket,time,author,newvalue\r\n'
+                                  '1,1440000000,alice,Duplicate of ticket:3.\r\n'
+                                  '3,1450000000,alice,Not imported yet.\r\n')
+        issues = {5: _FakeSyncedIssue(5), 6: _FakeSyncedIssue(6)}
+        self._sync(issues)
+        self.assertTrue(issues[5].commentBodies[0].startswith(u'Duplicate of ticket:3.'))
+        # Changes of tickets not imported yet must not move the high water mark beyond those synced.
+        self.assertEqual(tratihubis._readSyncState(self.syncStatePath)['highWaterMark'], 1440000000)
+
+    def testCanContinueInterruptedSync(self):
+        issues = {5: _FakeSyncedIssue(5), 6: _FakeSyncedIssue(6, failingCommentCount=0)}
+        self.assertRaises(github.GithubException, self._sync, issues)
+        syncState = tratihubis._readSyncState(self.syncStatePath)
+        self.assertEqual(syncState['highWaterMark'], 1435000000)
+        self.assertEqual(syncState['synced'], {1: 1440000000})
+
+        tratihubis._defaultSession = tratihubis.MigrationSession()
+        issues[6] = _FakeSyncedIssue(6)
+        self._sync(issues)
+        self.assertEqual(len(issues[5].commentBodies), 1)
+        self.assertEqual(len(issues[6].commentBodies), 1)
+        self.assertEqual(tratihubis._readSyncState(self.syncStatePath)['highWaterMark'], 1440000000)
+
+
+def _writeTicketsCsv(folder, ticketIds):
+    '''
+    Write a tickets CSV in the format of ``query_tickets.sql`` with a ticket for each of ``ticketIds``.
+    '''
+    ticketsCsvPath = os.path.join(folder, 'tickets.csv')
+    with open(ticketsCsvPath, 'wb') as ticketsCsvFile:
+        ticketsCsvFile.write('id,type,owner,reporter,milestone,status,resolution,summary,description,'
+                'createdtime,modifiedtime,component,priority,keywords,cc\r\n')
+        for ticketId in ticketIds:
+            ticketsCsvFile.write('%d,defect,alice,bob,,new,,Ticket %d,"First line\nSecond line, \xc3\xa4",'
+                    '1420000000,1430000000,core,major,,\r\n' % (ticketId, ticketId))
+    return ticketsCsvPath
+
+
+class TicketIndexTest(_TempFolderTest):
+    def testCanReadSelectedTickets(self):
+        ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2, 5, 3])
+        ticketIndex = tratihubis._TicketIndex(ticketsCsvPath)
+        self.assertTrue(os.path.exists(ticketsCsvPath + '.index'))
+        self.assertEqual([row[0] for row in ticketIndex.rows(firstTicketId=3)], [u'5', u'3'])
+        ticketMaps = list(tratihubis._tracTicketMaps(ticketsCsvPath, [2]))
+        self.assertEqual(len(ticketMaps), 1)
+        self.assertEqual(ticketMaps[0]['summary'], u'Ticket 2')
+        self.assertEqual(ticketMaps[0]['description'], u'First line\nSecond line, \xe4')
+        self.assertEqual([ticketMap['id'] for ticketMap in tratihubis._tracTicketMaps(ticketsCsvPath, None, 2, 3)],
+                [2, 3])
+
+    def testCanRebuildOutdatedIndex(self):
+        ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2])
+        tratihubis._TicketIndex(ticketsCsvPath)
+        _writeTicketsCsv(self.tempFolder, [1, 2, 3, 4])
+        # Make sure the index is outdated even if the file system has a coarse modification time.
+        os.utime(ticketsCsvPath, (0, 0))
+        ticketIndex = tratihubis._TicketIndex(ticketsCsvPath)
+        self.assertEqual([ticketId for ticketId, _ in ticketIndex.ticketOffsets], [1, 2, 3, 4])
+
+
+class RevisionIndexTest(_TempFolderTest):
+    def _writeRevisionMap(self, lines):
+        result = os.path.join(self.tempFolder, 'revisions.txt')
+        with open(result, 'wb') as revisionMapFile:
+            revisionMapFile.write(''.join(line + '\n' for line in lines))
+        return result
+
+    def testCanLookUpRevisions(self):
+        revisionMapPath = self._writeRevisionMap([
+            'r7 | 0123abc | Fix crash',
+            '------------------------------------------------------------------------',
+            '5 89ABCDEF0123456789abcdef0123456789abcdef',
+        ])
+        revisionIndex = tratihubis._RevisionIndex(revisionMapPath)
+        try:
+            self.assertTrue(os.path.exists(revisionMapPath + '.index'))
+            self.assertEqual(revisionIndex.get(7), '0123abc')
+            self.assertEqual(revisionIndex.get(5), '89abcdef0123456789abcdef0123456789abcdef')
+            for revision in (4, 6, 8):
+                self.assertEqual(revisionIndex.get(revision), None)
+        finally:
+            revisionIndex.close()
+        unpickledRevisionIndex = pickle.loads(pickle.dumps(tratihubis._RevisionIndex(revisionMapPath)))
+        self.assertEqual(unpickledRevisionIndex.get(7), '0123abc')
+
+    def testCanRebuildOutdatedIndex(self):
+        revisionMapPath = self._writeRevisionMap(['1 0123abc'])
+        tratihubis._RevisionIndex(revisionMapPath).close()
+        self._writeRevisionMap(['1 0123abc', '2 4567def'])
+        # Make sure the index is outdated even if the file system has a coarse modification time.
+        os.utime(revisionMapPath, (0, 0))
+        self.assertEqual(tratihubis._RevisionIndex(revisionMapPath).get(2), '4567def')
+
+    def testCanLookUpRevisionsWithoutIndex(self):
+        revisionMapPath = self._writeRevisionMap(['3 0123abc'])
+        os.mkdir(revisionMapPath + '.index.tmp')
+        self.assertEqual(tratihubis._RevisionIndex(revisionMapPath).get(3), '0123abc')
+
+
+class ParallelCommentsCsvTest(_TempFolderTest):
+    def setUp(self):
+        super(ParallelCommentsCsvTest, self).setUp()
+        self.commentsCsvPath = os.path.join(self.tempFolder, 'comments.csv')
+        with open(self.commentsCsvPath, 'wb') as commentsCsvFile:
+            commentsCsvWriter = csv.writer(commentsCsvFile)
+            commentsCsvWriter.writerow(['ticket', 'time', 'author', 'newvalue'])
+            for commentIndex in range(200):
+                commentsCsvWriter.writerow([commentIndex % 7 + 1, 1420000000 + commentIndex, 'alice',
+                        'Comment %d\nwith "quotes",\n\xc3\xa4 and lines' % commentIndex * (commentIndex % 3)])
+
+    def testCanSplitAtRowBoundaries(self):
+        chunkOffsets = tratihubis._csvChunkOffsets(self.commentsCsvPath, 9, blockSize=16)
+        self.assertEqual(chunkOffsets[0], 0)
+        self.assertEqual(chunkOffsets[-1], os.path.getsize(self.commentsCsvPath))
+        rowCount = 0
+        with open(self.commentsCsvPath, 'rb') as commentsCsvFile:
+            for start, end in zip(chunkOffsets, chunkOffsets[1:]):
+                commentsCsvFile.seek(start)
+                rows = list(csv.reader(StringIO.StringIO(commentsCsvFile.read(end - start))))
+                self.assertTrue(all(len(row) == 4 for row in rows))
+                rowCount += len(rows)
+        self.assertEqual(rowCount, 201)
+
+    def testCanParseInParallel(self):
+        self.assertEqual(tratihubis._parallelTicketToCommentsMap(self.commentsCsvPath, 3),
+                         tratihubis._createTicketToCommentsMap(self.commentsCsvPath, 1))
+
+    def testFailsOnBrokenRow(self):
+        with open(self.commentsCsvPath, 'ab') as commentsCsvFile:
+            commentsCsvFile.write('8,1430000000,bob\r\n')
+        self.assertRaises(tratihubis._CsvDataError, tratihubis._parallelTicketToCommentsMap, self.commentsCsvPath, 2)
+
+
+def _gzipCompressed(data):
+    result = StringIO.StringIO()
+    with contextlib.closing(gzip.GzipFile(fileobj=result, mode='wb')) as gzipFile:
+        gzipFile.write(data)
+    return result.getvalue()
+
+
+class CompressedCsvTest(_TempFolderTest):
+    def _compressedCopy(self, path, suffix, compress):
+        result = path + suffix
+        with open(path, 'rb') as sourceFile:
+            data = sourceFile.read()
+        with open(result, 'wb') as targetFile:
+            # Two streams in one file, like concatenated gzip files.
+            targetFile.write(compress(data[:100]))
+            targetFile.write(compress(data[100:]))
+        return result
+
+    def testCanReadGzipAndBzip2(self):
+        ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2, 5, 3])
+        expectedTicketMaps = list(tratihubis._tracTicketMaps(ticketsCsvPath))
+        for suffix, openCompressed in (('.gz', _gzipCompressed), ('.bz2', bz2.compress)):
+            compressedCsvPath = self._compressedCopy(ticketsCsvPath, suffix, openCompressed)
+            self.assertEqual(list(tratihubis._tracTicketMaps(compressedCsvPath)), expectedTicketMaps)
+            self.assertEqual([ticketMap['id'] for ticketMap in tratihubis._tracTicketMaps(compressedCsvPath, [2, 3])],
+                             [2, 3])
+            self.assertFalse(os.path.exists(compressedCsvPath + '.index'))
+
+    def testCanReadInSmallBlocks(self):
+        path = os.path.join(self.tempFolder, 'some.txt')
+        with open(path, 'wb') as someFile:
+            someFile.write('x' * 1000)
+        compressedPath = self._compressedCopy(path, '.gz', _gzipCompressed)
+        reader = tratihubis._DecompressingReader(compressedPath, tratihubis._COMPRESSED_SUFFIXES['.gz'][1],
+                                                 blockSize=7, queueSize=1)
+        with reader:
+            self.assertEqual(reader.read(10), 'x' * 10)
+            self.assertEqual(reader.read(), 'x' * 990)
+            self.assertEqual(reader.read(), '')
+
+    def testCanParseCompressedCommentsWithSingleProcess(self):
+        commentsCsvPath = os.path.join(self.tempFolder, 'comments.csv')
+        with open(commentsCsvPath, 'wb') as commentsCsvFile:
+            commentsCsvWriter = csv.writer(commentsCsvFile)
+            commentsCsvWriter.writerow(['ticket', 'time', 'author', 'newvalue'])
+            for commentIndex in range(50):
+                commentsCsvWriter.writerow([commentIndex % 7 + 1, 1420000000 + commentIndex, 'alice',
+                        'Comment %d\nwith "quotes",\n\xc3\xa4' % commentIndex])
+        compressedCsvPath = self._compressedCopy(commentsCsvPath, '.bz2', bz2.compress)
+        self.assertEqual(tratihubis._createTicketToCommentsMap(compressedCsvPath, 3),
+                         tratihubis._createTicketToCommentsMap(commentsCsvPath, 1))
+
+    def testFailsOnBrokenData(self):
+        brokenCsvPath = os.path.join(self.tempFolder, 'comments.csv.gz')
+        with open(brokenCsvPath, 'wb') as brokenCsvFile:
+            brokenCsvFile.write('no gzip')
+        self.assertRaises(zlib.error, tratihubis._createTicketToCommentsMap, brokenCsvPath)
+
+
+class StagingDatabaseTest(_TempFolderTest):
+    def testCanIngestAndReadTickets(self):
+        ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 3, 2])
+        commentsCsvPath = os.path.join(self.tempFolder, 'comments.csv')
+        with open(commentsCsvPath, 'wb') as commentsCsvFile:
+            commentsCsvFile.write('ticket,time,author,newvalue\r\n3,1425000000,alice,Some comment\r\n')
+        stagingDatabasePath = os.path.join(self.tempFolder, 'staging.db')
+        counts = tratihubis.ingestTickets(stagingDatabasePath, ticketsCsvPath, commentsCsvPath)
+        self.assertEqual(counts, {'ticket': 3, 'comment': 1, 'attachment': 0})
+
+        stagingDatabase = tratihubis._StagingDatabase(stagingDatabasePath)
+        try:
+            self.assertEqual(list(tratihubis._tracTicketMaps(stagingDatabase)),
+                    list(tratihubis._tracTicketMaps(ticketsCsvPath)))
+            self.assertEqual([ticketMap['id'] for ticketMap in tratihubis._tracTicketMaps(stagingDatabase, None, 2)],
+                    [3, 2])
+            self.assertEqual([ticketMap['id'] for ticketMap in tratihubis._tracTicketMaps(stagingDatabase, [1, 2])],
+                    [1, 2])
+            self.assertEqual(tratihubis._createTicketToCommentsMap(stagingDatabase),
+                    tratihubis._createTicketToCommentsMap(commentsCsvPath))
+        finally:
+            stagingDatabase.close()
+
+    def testFailsOnMissingStagingDatabase(self):
+        self.assertRaises(tratihubis._ConfigError, tratihubis._StagingDatabase,
+                os.path.join(self.tempFolder, 'missing.db'))
+
+
+class RenderTest(_TempFolderTest):
+    def testCanRenderTickets(self):
+        ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2, 3])
+        commentsCsvPath = os.path.join(self.tempFolder, 'comments.csv')
+        with open(commentsCsvPath, 'wb') as commentsCsvFile:
+            commentsCsvFile.write('ticket,time,author,newvalue\r\n2,1425000000,alice,See ticket:3\r\n')
+        for processCount in (1, 2):
+            renderFolder = os.path.join(self.tempFolder, 'rendered%d' % processCount)
+            renderedCount = tratihubis.renderTickets('me/mytool', 'me', ticketsCsvPath, renderFolder, commentsCsvPath,
+                    convert_text=True, userLoginMapping='alice: alicegh, *: me', processCount=processCount)
+            self.assertEqual(renderedCount, 3)
+            self.assertEqual(sorted(os.listdir(renderFolder)), ['1.md', '2.md', '3.md'])
+            with open(os.path.join(renderFolder, '2.md'), 'rb') as renderedFile:
+                rendered = renderedFile.read().decode('utf-8')
+            self.assertTrue(rendered.startswith(u'# Issue #2: Ticket 2\n'))
+            self.assertTrue(u'alicegh' in rendered)
+            self.assertTrue(u'See issue #3' in rendered)
+            self.assertTrue(u'<!-- tratihubis:ticket=2:comment=0 -->' in rendered)
+
+
+def _writeCassette(folder, interactions, maxSeconds=None):
+    result = os.path.join(folder, 'cassette.json')
+    with open(result, 'wb') as cassetteFile:
+        json.dump({'maxSeconds': maxSeconds, 'interactions': interactions}, cassetteFile)
+    return result
+
+
+def _cassetteInteraction(url, body, seconds=0.0):
+    return {'method': 'GET', 'url': url, 'status': 200, 'seconds': seconds,
+            'headers': {'content-type': 'application/json; charset=utf-8'}, 'body': json.dumps(body)}
+
+
+class CassetteTest(_TempFolderTest):
+    def _writeCassette(self, interactions, maxSeconds=None):
+        return _writeCassette(self.tempFolder, interactions, maxSeconds)
+
+    def _interaction(self, url, body, seconds=0.0):
+        return _cassetteInteraction(url, body, seconds)
+
+    def testCanReplayRequests(self):
+        cassettePath = self._writeCassette([
+            self._interaction('/users/alicegh', {'login': 'alicegh', 'name': u'Alice \xc4'}),
+            self._interaction('/users/bobgh', {'login': 'bobgh', 'name': u'Bob'}),
+        ])
+        cassette = github_cassette.Cassette(cassettePath, latency=0.01)
+        cassette.start()
+        try:
+            hub = github.Github()
+            self.assertEqual(hub.get_user('bobgh').name, u'Bob')
+            self.assertEqual(hub.get_user('alicegh').name, u'Alice \xc4')
+            self.assertRaises(github_cassette.CassetteError, hub.get_user, 'carolgh')
+        finally:
+            cassette.stop()
+        self.assertEqual(cassette.requestCount, 3)
+        self.assertEqual(cassette.unusedInteractions(), [])
+        self.assertAlmostEqual(cassette.simulatedSeconds, 0.02)
+        self.assertTrue(0 <= cassette.localSeconds < cassette.elapsedSeconds)
+
+    def testCanDetectUnusedRequests(self):
+        cassettePath = self._writeCassette([self._interaction('/users/alicegh', {'login': 'alicegh'})])
+        cassette = github_cassette.Cassette(cassettePath)
+        cassette.start()
+        cassette.stop()
+        self.assertEqual([interaction['url'] for interaction in cassette.unusedInteractions()], ['/users/alicegh'])
+
+    def testCanRecordRequests(self):
+        cassettePath = os.path.join(self.tempFolder, 'recorded', 'cassette.json')
+        recordingCassette = github_cassette.Cassette(cassettePath, github_cassette.MODE_RECORD)
+        recordingCassette.start()
+        recordingCassette._record('GET', '/users/alicegh', 200, {}, json.dumps({'login': 'alicegh'}), 0.5)
+        recordingCassette.stop()
+        replayingCassette = github_cassette.Cassette(cassettePath, latency=github_cassette.LATENCY_RECORDED)
+        self.assertEqual(replayingCassette.interactions, recordingCassette.interactions)
+        self.assertTrue(replayingCassette.maxSeconds >= 1.0)
+
+
+def _hasGit():
+    try:
+        return subprocess.call(['git', '--version'], stdout=open(os.devnull, 'wb')) == 0
+    except OSError:
+        return False
+
+
+@unittest.skipIf(not _hasGit(), 'git must be installed')
+class WikiTest(_TempFolderTest):
+    def setUp(self):
+        super(WikiTest, self).setUp()
+        self.wikiCsvPath = os.path.join(self.tempFolder, 'wiki.csv')
+        with open(self.wikiCsvPath, 'wb') as wikiCsvFile:
+            wikiCsvFile.write('name,version,time,author,text,comment\r\n'
+                              'WikiStart,1,1425000000,alice,"= Welcome =\n",\r\n'
+                              'WikiStart,2,1425000300000000,alice,"= Welcome =\nSee [wiki:Dev/Setup].\n",Add link\r\n'
+                              'Dev/Setup,1,1425000200,bob,Fixed in ticket:2.,\r\n'
+                              'TracGuide,1,1424000000,trac,"= The Trac User and Administration Guide =\n",\r\n')
+
+    def _gitOutput(self, gitRepoPath, *arguments):
+        return subprocess.Popen(('git',) + arguments, cwd=gitRepoPath, stdout=subprocess.PIPE).communicate()[0]
+
+    def testCanMigrateLatestPages(self):
+        for processCount in (1, 2):
+            gitRepoPath = os.path.join(self.tempFolder, 'wiki%d' % processCount)
+            pageCount = tratihubis.migrateWiki('me/mytool', 'me', self.wikiCsvPath, gitRepoPath, {2: 5},
+                                               convert_text=True, processCount=processCount)
+            self.assertEqual(pageCount, 2)
+            self.assertEqual(self._gitOutput(gitRepoPath, 'rev-list', '--count', 'master').strip(), '1')
+            self.assertEqual(self._gitOutput(gitRepoPath, 'ls-tree', '-r', '--name-only', 'master').splitlines(),
+                             ['Dev/Setup.md', 'Home.md'])
+            self.assertEqual(self._gitOutput(gitRepoPath, 'show', 'master:Home.md'),
+                             '# Welcome\nSee [wiki:Dev/Setup].\n')
+            self.assertEqual(self._gitOutput(gitRepoPath, 'show', 'master:Dev/Setup.md'), 'Fixed in issue #5.')
+
+    def testCanMigratePageHistory(self):
+        gitRepoPath = os.path.join(self.tempFolder, 'wiki')
+        pageCount = tratihubis.migrateWiki('me/mytool', 'me', self.wikiCsvPath, gitRepoPath, {2: 5},
+                                           history=True, includeTracPages=True,
+                                           userLoginMapping='alice: alicegh, *: me', processCount=1)
+        self.assertEqual(pageCount, 4)
+        self.assertEqual(self._gitOutput(gitRepoPath, 'log', '--reverse', '--format=%an %s', 'master').splitlines(),
+                         ['me Update TracGuide', 'alicegh Update WikiStart', 'me Update Dev/Setup', 'alicegh Add link'])
+        self.assertEqual(self._gitOutput(gitRepoPath, 'show', 'master:Dev/Setup.md'), 'Fixed in ticket:2.')
+
+
+class _FakeObject(object):
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class _FakeIssues(object):
+    def __init__(self, issues, pageSize):
+        self._issues = issues
+        self._pageSize = pageSize
+
+    def get_page(self, pageIndex):
+        return self._issues[pageIndex * self._pageSize:(pageIndex + 1) * self._pageSize]
+
+
+class VerifyTest(_TempFolderTest):
+    def testCanReadTicketsToIssuesMap(self):
+        ticketMapPath = os.path.join(self.tempFolder, 'tickets.map')
+        with open(ticketMapPath, 'wb') as ticketMapFile:
+            ticketMapFile.write('1 3\n2 4')
+        self.assertEqual(tratihubis._readTicketsToIssuesMap(ticketMapPath), {1: 3, 2: 4})
+
+        eventLogPath = os.path.join(self.tempFolder, 'events.jsonl')
+        eventLog = tratihubis._EventLog(eventLogPath)
+        eventLog.log('run_started', pretend=True)
+        eventLog.log('ticket_converted', ticket=1, issue=1)
+        eventLog.log('run_started', pretend=False)
+        eventLog.log('ticket_converted', ticket=1, issue=3)
+        eventLog.close()
+        self.assertEqual(tratihubis._ticketsToIssuesMapFromEventLog(eventLogPath), {1: 3})
+
+    def testCanFindProblems(self):
+        ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2, 3])
+        commentsCsvPath = os.path.join(self.tempFolder, 'comments.csv')
+        with open(commentsCsvPath, 'wb') as commentsCsvFile:
+            commentsCsvFile.write('ticket,time,author,newvalue\r\n2,1425000000,alice,Fixed.\r\n')
+        ticketToCommentsMap = tratihubis._createTicketToCommentsMap(commentsCsvPath)
+        ticketsToIssuesMap = {1: 1, 2: 2, 3: 3}
+        markupTranslator = translator.NullTranslator('https://github.com/me/mytool', ticketsToIssuesMap)
+        issues = []
+        for ticketMap in tratihubis._tracTicketMaps(ticketsCsvPath, [1, 2]):
+            title, body, commentBodies = tratihubis._convertedTicket(ticketMap,
+                    ticketToCommentsMap.get(ticketMap['id'], []), [], markupTranslator, {'*': 'me'}, 'me')
+            comments = [_FakeObject(body=commentBody) for commentBody in commentBodies * 2]
+            issues.append(_FakeObject(number=ticketMap['id'], title=title, body=body, state='open', labels=[],
+                                      comments=len(comments), get_comments=lambda comments=comments: comments))
+        issues[1].state = 'closed'
+        repo = _FakeObject(full_name='me/mytool', name='mytool', owner=_FakeObject(login='me'),
+                           get_issues=lambda **_: _FakeIssues(issues, 1))
+        hub = _FakeObject(get_user=lambda: _FakeObject(login='me'))
+
+        problems = tratihubis.verifyTickets(hub, repo, ticketsCsvPath, ticketsToIssuesMap, commentsCsvPath,
+                                            threadCount=2)
+        self.assertEqual(sorted((problem.ticketId, problem.kind) for problem in problems),
+                         [(2, 'duplicate_comment'), (2, 'state'), (3, 'missing_issue')])
+
+
+class VerifyThreadsTest(_TempFolderTest):
+    def setUp(self):
+        super(VerifyThreadsTest, self).setUp()
+        tratihubis._defaultSession = tratihubis.MigrationSession()
+        self.ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2])
+        markupTranslator = translator.NullTranslator('https://github.com/me/mytool', {1: 1, 2: 2})
+        repoUrl = 'https://api.github.com/repos/me/mytool'
+        issues = []
+        for ticketMap in tratihubis._tracTicketMaps(self.ticketsCsvPath):
+            title, body, _ = tratihubis._convertedTicket(ticketMap, [], [], markupTranslator, {'*': 'me'}, 'me')
+            issues.append({'number': ticketMap['id'], 'title': title, 'body': body, 'state': 'open', 'labels': [],
+                           'comments': 0, 'url': '%s/issues/%d' % (repoUrl, ticketMap['id'])})
+        issues[1]['comments'] = 1
+        issuesUrl = '/repos/me/mytool/issues?sort=created&state=all&direction=asc'
+        self.cassettePath = _writeCassette(self.tempFolder, [
+            _cassetteInteraction('/user', {'login': 'me'}),
+            _cassetteInteraction('/repos/me/mytool', {'url': repoUrl, 'full_name': 'me/mytool', 'name': 'mytool',
+                                                      'owner': {'login': 'me'}}),
+            _cassetteInteraction(issuesUrl, [issues[0]]),
+            _cassetteInteraction(issuesUrl + '&page=2', [issues[1]]),
+            _cassetteInteraction(issuesUrl + '&page=3', []),
+            _cassetteInteraction(issuesUrl + '&page=4', []),
+            _cassetteInteraction('/repos/me/mytool/issues/2/comments', [{'body': 'Posted later.'}]),
+        ])
+
+    def _verify(self, createHub):
+        # The latency keeps requests pending long enough for other threads to send theirs at the same time.
+        cassette = github_cassette.Cassette(self.cassettePath, latency=0.05)
+        cassette.start()
+        try:
+            hub = github.Github()
+            repo = hub.get_repo('me/mytool')
+            return tratihubis.verifyTickets(hub, repo, self.ticketsCsvPath, {1: 1, 2: 2}, threadCount=2,
+                                            createHub=createHub or (lambda: hub))
+        finally:
+            cassette.stop()
+
+    def testCanFetchPagesWithHubPerThread(self):
+        self.assertEqual(self._verify(github.Github), [])
+
+    def testFailsOnPagesFetchedThroughSameHub(self):
+        self.assertRaises(github_cassette.CassetteError, self._verify, None)
+
+
+class CheckTest(_TempFolderTest):
+    def testCanFindProblems(self):
+        ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2, 3])
+        with open(ticketsCsvPath, 'ab') as ticketsCsvFile:
+            ticketsCsvFile.write('2,defect,alice,bob,,new,,Again,,1420000000,1430000000,core,major,,\r\n'
+                                 '4,defect,carol,bob,,new,,Broken,,1420000000\r\n'
+                                 '5,defect,carol,bob,,new,,Huge,%s,1420000000,1430000000,core,major,,\r\n'
+                                 % ('x' * 70000))
+        commentsCsvPath = os.path.join(self.tempFolder, 'comments.csv')
+        with open(commentsCsvPath, 'wb') as commentsCsvFile:
+            commentsCsvFile.write('ticket,time,author,newvalue\r\n'
+                                  '1,1425000000,alice,See ticket:3 and ticket:9.\r\n'
+                                  '1,soon,alice,Fixed.\r\n'
+                                  '7,1425000000,dave,Lost.\r\n')
+        repo = _FakeObject(full_name='me/mytool', get_collaborators=lambda: [_FakeObject(login='alicegh')],
+                           get_labels=lambda: [_FakeObject(name='bug')])
+        problems = tratihubis.checkTickets('mytool', 'me', ticketsCsvPath, commentsCsvPath, repo=repo,
+                                           labelMapping='type=defect: bug',
+                                           userLoginMapping='alice: alicegh, bob: me, carol: carolgh',
+                                           convert_text=True)
+        self.assertEqual(sorted((problem.rowIndex, problem.ticketId, problem.kind) for problem in problems), [
+            (None, None, 'assignee'),
+            (1, 1, 'reference'),
+            (2, None, 'value'),
+            (3, 7, 'unknown_ticket'),
+            (3, 7, 'user'),
+            (4, 2, 'duplicate'),
+            (5, None, 'columns'),
+            (6, 5, 'body_size'),
+        ])
+        self.assertTrue('carolgh' in [problem.message for problem in problems if problem.kind == 'assignee'][0])
+
+    def testCanFindBrokenEncodingAndContinue(self):
+        ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1])
+        with open(ticketsCsvPath, 'ab') as ticketsCsvFile:
+            ticketsCsvFile.write('2,defect,alice,bob,,new,,Not UTF-8 \xff,,1420000000,1430000000,core,major,,\r\n'
+                                 '3,defect,alice,bob,,new,,Null \x00 byte,,1420000000,1430000000,core,major,,\r\n'
+                                 '2,defect,alice,bob,,new,,Fine,,1420000000,1430000000,core,major,,\r\n')
+        problems = tratihubis.checkTickets('mytool', 'me', ticketsCsvPath)
+        self.assertEqual([(problem.rowIndex, problem.kind) for problem in problems], [(2, 'encoding'), (3, 'encoding')])
+
+    def testCanFoldUnsortedComments(self):
+        ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2])
+        commentsCsvPath = os.path.join(self.tempFolder, 'comments.csv')
+        with open(commentsCsvPath, 'wb') as commentsCsvFile:
+            commentsCsvFile.write('ticket,time,author,newvalue\r\n'
+                                  '1,1425000000,alice,%s\r\n'
+                                  '2,1425000000,alice,Other ticket.\r\n'
+                                  '1,1425000100,alice,Fixed.\r\n' % ('x' * 70000))
+        problems = tratihubis.checkTickets('mytool', 'me', ticketsCsvPath, commentsCsvPath, foldCommentsThreshold=1)
+        self.assertEqual(problems, [])
+        problems = tratihubis.checkTickets('mytool', 'me', ticketsCsvPath, commentsCsvPath)
+        self.assertEqual([(problem.rowIndex, problem.kind) for problem in problems], [(1, 'comment_size')])
+
+
+class ArchiveTest(_TempFolderTest):
+    def testCanWriteMigrationArchive(self):
+        ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2, 3])
+        commentsCsvPath = os.path.join(self.tempFolder, 'comments.csv')
+        with open(commentsCsvPath, 'wb') as commentsCsvFile:
+            commentsCsvFile.write('ticket,time,author,newvalue\r\n2,1425000000,alice,See ticket:3\r\n')
+        archivePath = os.path.join(self.tempFolder, 'migration.tar.gz')
+        recordCounts = tratihubis.archiveTickets('me/mytool', 'me', ticketsCsvPath, archivePath, commentsCsvPath,
+                labelMapping='type=defect: bug', convert_text=True, userLoginMapping='alice: alicegh, *: me',
+                batchSize=2)
+        self.assertEqual(recordCounts['issues'], 3)
+        self.assertEqual(recordCounts['issue_comments'], 1)
+        archive = tarfile.open(archivePath)
+        try:
+            self.assertEqual(sorted(archive.getnames()), ['issue_comments_000001.json', 'issues_000001.json',
+                    'issues_000002.json', 'repositories_000001.json', 'schema.json', 'users_000001.json'])
+            issues = json.load(archive.extractfile('issues_000001.json'))
+            self.assertEqual(issues[1]['url'], u'https://github.com/me/mytool/issues/2')
+            self.assertEqual(issues[1]['labels'], [u'https://github.com/me/mytool/labels/bug'])
+            self.assertEqual(issues[1]['assignee'], u'https://github.com/alicegh')
+            comments = json.load(archive.extractfile('issue_comments_000001.json'))
+            self.assertEqual(comments[0]['user'], u'https://github.com/alicegh')
+            self.assertTrue(u'See issue #3' in comments[0]['body'])
+            repositories = json.load(archive.extractfile('repositories_000001.json'))
+            self.assertEqual([label['name'] for label in repositories[0]['labels']], [u'bug'])
+            users = json.load(archive.extractfile('users_000001.json'))
+            self.assertEqual([user['login'] for user in users], [u'alicegh', u'me'])
+        finally:
+            archive.close()
+        self.assertFalse(os.path.exists(archivePath + '.tmp'))
+
+    def testCanDiscardBrokenMigrationArchive(self):
+        ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2])
+        archivePath = os.path.join(self.tempFolder, 'migration.tar.gz')
+        self.assertRaises(tratihubis._ConfigError, tratihubis.archiveTickets, 'me/mytool', 'me', ticketsCsvPath,
+                          archivePath, userLoginMapping='alice: alicegh', batchSize=1)
+        self.assertEqual(os.listdir(self.tempFolder), ['tickets.csv'])
+
+
+def _createTracSqliteDatabase(tracDatabasePath):
+    '''
+    Create a minimal Trac SQLite database with 2 tickets, 2 comments and 2 attachments.
+    '''
+    connection = sqlite3.connect(tracDatabasePath)
+    connection.executescript('''
+        create table ticket (
+            id integer primary key, type text, time integer, changetime integer, component text,
+            severity text, priority text, owner text, reporter text, cc text, version text, milestone text,
+            status text, resolution text, summary text, description text, keywords text);
+        create table ticket_change (
+            ticket integer, time integer, author text, field text, oldvalue text, newvalue text);
+        create table attachment (
+            type text, id text, filename text, size integer, time integer, description text, author text,
+            ipnr text);
+        insert into ticket values (
+            1, 'defect', 1430000000000000, 1430000600000000, 'core', null, 'major', 'johndoe', 'roskakori', '',
+            null, '0.5.0', 'closed', 'fixed', 'Test defect', 'A simple defect.', 'mac windows');
+        insert into ticket values (
+            2, 'enhancement', 1430001000, 1430001000, null, null, 'minor', '', 'roskakori', 'x@example.com',
+            null, null, 'new', null, 'Test enhancement', 'Multiple
+lines.', null);
+        insert into ticket_change values (1, 1430000100000000, 'crashfest', 'comment', '1', 'This does not work!');
+        insert into ticket_change values (1, 1430000200000000, 'roskakori', 'comment', '2', '');
+        insert into ticket_change values (1, 1430000300000000, 'roskakori', 'status', 'new', 'closed');
+        insert into ticket_change values (2, 1430001100, 'fanboy', 'comment', '1', 'Nice feature.');
+        insert into attachment values ('ticket', '1', 'crash.log', 10, 1430000150000000, '', 'crashfest', '');
+        insert into attachment values ('wiki', 'WikiStart', 'logo.png', 10, 1430000150, '', 'roskakori', '');
+    ''')
+    connection.commit()
+    connection.close()
+
+
+class TracDatabaseTest(_TempFolderTest):
+    def setUp(self):
+        super(TracDatabaseTest, self).setUp()
+        tracDatabasePath = os.path.join(self.tempFolder, 'trac.db')
+        _createTracSqliteDatabase(tracDatabasePath)
+        self.tracDatabase = tratihubis._TracDatabase('sqlite:' + tracDatabasePath)
+
+    def tearDown(self):
+        self.tracDatabase.close()
+        super(TracDatabaseTest, self).tearDown()
+
+    def testCanReadTickets(self):
+        ticketMaps = list(tratihubis._tracTicketMaps(self.tracDatabase))
+        self.assertEqual([ticketMap['id'] for ticketMap in ticketMaps], [1, 2])
+        self.assertEqual(ticketMaps[0]['keywords'], ['mac', 'windows'])
+        self.assertEqual(ticketMaps[0]['createdtime'], datetime.datetime.fromtimestamp(1430000000))
+        self.assertEqual(ticketMaps[1]['milestone'], u'')
+        self.assertEqual(ticketMaps[1]['description'], u'Multiple\nlines.')
+
+    def testCanReadComments(self):
+        ticketToCommentsMap = tratihubis._createTicketToCommentsMap(self.tracDatabase)
+        self.assertEqual(sorted(ticketToCommentsMap.keys()), [1, 2])
+        self.assertEqual([comment['body'] for comment in ticketToCommentsMap[1]], [u'This does not work!'])
+        self.assertEqual(ticketToCommentsMap[2][0]['date'], datetime.datetime.fromtimestamp(1430001100))
+
+    def testCanReadAttachments(self):
+        ticketToAttachmentsMap = tratihubis._createTicketsToAttachmentsMap(
+                self.tracDatabase, 'http://example.com/attachments', None)
+        self.assertEqual(ticketToAttachmentsMap.keys(), [1])
+        self.assertEqual(ticketToAttachmentsMap[1][0]['fullpath'], u'http://example.com/attachments/1/crash.log')
+
+
+class _TracAttachmentsTest(_TempFolderTest):
+    '''
+    Like `_TempFolderTest` but with a `_writeTracAttachment()` to store attachment files like Trac does.
+    '''
+    def _writeTracAttachment(self, tracFolder, ticketId, filename, content):
+        attachmentMap = tratihubis._attachmentMapFromRow(
+                [unicode(ticketId), filename, 1430000000, u'roskakori'], u'http://example.com/att', tracFolder)
+        tracFolderOfTicket = os.path.dirname(attachmentMap['tracpath'])
+        if not os.path.exists(tracFolderOfTicket):
+            os.makedirs(tracFolderOfTicket)
+        with open(attachmentMap['tracpath'], 'wb') as attachmentFile:
+            attachmentFile.write(content)
+        return attachmentMap
+
+
+class CopyTracAttachmentsTest(_TracAttachmentsTest):
+    def testCanCopyAndDeduplicateAttachments(self):
+        tracFolder = os.path.join(self.tempFolder, 'trac')
+        targetFolder = os.path.join(self.tempFolder, 'target')
+        ticketToAttachmentsMap = {
+            1: [self._writeTracAttachment(tracFolder, 1, u'a.txt', 'same'),
+                self._writeTracAttachment(tracFolder, 1, u'b.txt', 'other')],
+            2: [self._writeTracAttachment(tracFolder, 2, u'a.txt', 'same')],
+        }
+        result = tratihubis._copyTracAttachments(ticketToAttachmentsMap, u'http://example.com/att', targetFolder, 2)
+        self.assertEqual(result, {'copied': 2, 'linked': 1, 'skipped': 0})
+        for ticketId, filename, content in [(1, 'a.txt', 'same'), (1, 'b.txt', 'other'), (2, 'a.txt', 'same')]:
+            with open(os.path.join(targetFolder, str(ticketId), filename), 'rb') as attachmentFile:
+                self.assertEqual(attachmentFile.read(), content)
+
+        result = tratihubis._copyTracAttachments(ticketToAttachmentsMap, u'http://example.com/att', targetFolder, 2)
+        self.assertEqual(result, {'copied': 0, 'linked': 0, 'skipped': 3})
+
+
+@unittest.skipIf(not _hasGit(), 'git must be installed')
+class PublishAttachmentsToGitTest(_TracAttachmentsTest):
+    def _gitOutput(self, gitRepoPath, *arguments):
+        return subprocess.Popen(('git',) + arguments, cwd=gitRepoPath, stdout=subprocess.PIPE).communicate()[0]
+
+    def testCanPublishAttachmentsAsSingleCommit(self):
+        tracFolder = os.path.join(self.tempFolder, 'trac')
+        gitRepoPath = os.path.join(self.tempFolder, 'attachments')
+        ticketToAttachmentsMap = {
+            1: [self._writeTracAttachment(tracFolder, 1, u'crash log.txt', 'crash')],
+            2: [self._writeTracAttachment(tracFolder, 2, u'a.txt', 'a')],
+        }
+        tratihubis._publishAttachmentsToGit(ticketToAttachmentsMap, gitRepoPath, 'master', 'attachments')
+        tratihubis._publishAttachmentsToGit(
+                {3: [self._writeTracAttachment(tracFolder, 3, u'b.txt', 'b')]}, gitRepoPath, 'master', 'attachments')
+        self.assertEqual(self._gitOutput(gitRepoPath, 'rev-list', '--count', 'master').strip(), '2')
+        self.assertEqual(self._gitOutput(gitRepoPath, 'ls-tree', '-r', '--name-only', 'master').splitlines(),
+                ['attachments/1/crash log.txt', 'attachments/2/a.txt', 'attachments/3/b.txt'])
+        self.assertEqual(self._gitOutput(gitRepoPath, 'show', 'master:attachments/1/crash log.txt'), 'crash')
+
+
+class _EditableText(object):
+    '''
+    Stand-in for a Github issue or comment that remembers the last edit.
+    '''
+    id = 1
+    number = 1
+
+    def __init__(self):
+        self.edited = None
+
+    def edit(self, body=None, title=None):
+        self.edited = body or title
+
+
+class TicketReferencesTest(unittest.TestCase):
+    def testCanFindReferencedTickets(self):
+        referencedTickets = translator.Translator('https://github.com/me/repo', {}).referencedTickets
+        self.assertEqual(referencedTickets(u'see ticket:12 and [ticket:3], also (ticket:12)'), set([3, 12]))
+        self.assertEqual(referencedTickets(u'no references'), set())
+
+    def testCanRewriteTicketReferences(self):
+        issue = _EditableText()
+        comment = _EditableText()
+        referencingTexts = [
+            tratihubis._ReferencingText(1, 1, 'body', issue, u'Like ticket:2.', u'Like ticket:2.\n\ninfo', u'', u'\n\ninfo'),
+            tratihubis._ReferencingText(1, 1, 'comment', comment, u'Unrelated', u'Unrelated', u'', u''),
+        ]
+        referenceTranslator = translator.Translator('https://github.com/me/repo', {1: 1, 2: 5})
+        self.assertEqual(tratihubis._rewriteTicketReferences(referencingTexts, referenceTranslator, pretend=False), 1)
+        self.assertEqual(issue.edited, u'Like issue #5.\n\ninfo')
+        self.assertEqual(comment.edited, None)
+
+    def testCanRewriteTicketReferencesInPartsOfFoldedComments(self):
+        # Only a comment that exceeds the limit by itself is split.
+        untranslatedComments = (u'Like ticket:2.\n' + u'a' * 80 + u'\nSee ticket:2.',)
+        firstTranslator = translator.Translator('https://github.com/me/repo', {})
+        translatedComments = [firstTranslator.translate(comment) for comment in untranslatedComments]
+        oldFoldedPartLimit = tratihubis._FOLDED_PART_LIMIT
+        tratihubis._FOLDED_PART_LIMIT = 60
+        try:
+            [(_, _, foldedBodyParts)] = tratihubis._foldedCommentGroups(1, translatedComments)
+            self.assertTrue(len(foldedBodyParts) > 1)
+            comments = [_EditableText() for _ in foldedBodyParts]
+            referencingTexts = [
+                tratihubis._ReferencingText(1, 1, 'comment', comments[partIndex], untranslatedComments,
+                                            foldedBodyPart, u'', foldedMarker, (partIndex, len(foldedBodyParts)))
+                for partIndex, (foldedBodyPart, foldedMarker) in enumerate(foldedBodyParts)]
+            referenceTranslator = translator.Translator('https://github.com/me/repo', {1: 1, 2: 5})
+            tratihubis._rewriteTicketReferences(referencingTexts, referenceTranslator, pretend=False)
+            self.assertTrue(u'issue #5' in comments[0].edited)
+            self.assertTrue(u'issue #5' in comments[-1].edited)
+            for comment, (_, foldedMarker) in zip(comments, foldedBodyParts):
+                if comment.edited is not None:
+                    self.assertTrue(comment.edited.endswith(foldedMarker))
+                    self.assertTrue(len(comment.edited) <= 60 + len(foldedMarker))
+
+            comment = _EditableText()
+            referencingText = referencingTexts[0]._replace(target=comment, part=(0, len(foldedBodyParts) + 1))
+            self.assertEqual(tratihubis._rewriteTicketReferences([referencingText], referenceTranslator,
+                                                                 pretend=False), 0)
+            self.assertEqual(comment.edited, None)
+        finally:
+            tratihubis._FOLDED_PART_LIMIT = oldFoldedPartLimit
+
+
+class TranslatorTest(unittest.TestCase):
+    def testCanKeepReferencesToUnknownTickets(self):
+        markupTranslator = translator.Translator('https://github.com/me/mytool', {1: 5})
+        self.assertEqual(markupTranslator.translate(u'see ticket:2, [ticket:2] and [x](ticket:2), not ticket:1'),
+                u'see ticket:2, [ticket:2] and [x](ticket:2), not issue #5')
+
+    def testCanSkipRulesWithoutTriggers(self):
+        markupTranslator = translator.Translator('https://github.com/me/mytool', {3: 5}, trac_url='http://trac',
+                attachmentsPrefix='http://trac/raw-attachment/ticket', profile=True)
+        self.assertEqual(markupTranslator.translate(u'plain text'), u'plain text')
+        # Only the rule for commit hashes has no trigger literal.
+        self.assertEqual(len(markupTranslator.profile), 1)
+        self.assertEqual(markupTranslator.translate(u'see ticket:3 and {{{code}}}', ticketId=7),
+                u'see issue #5 and `code`')
+        self.assertEqual(markupTranslator.translate(u'[[Image(a.png)]]', ticketId=7),
+                u'![a.png](http://trac/raw-attachment/ticket/7/a.png)')
+        self.assertEqual(len(markupTranslator.profileReport()), len(markupTranslator.profile))
+
+    def testCanFallBackOnSlowTranslation(self):
+        markupTranslator = translator.TimeLimitedTranslator('https://github.com/me/mytool', {3: 5},
+                timeLimit=0.2, fallback='fenced')
+        try:
+            slowText = fuzz_translator.adversarialMarkup(u'= x ', 60000)
+            self.assertEqual(markupTranslator.translate(slowText, ticketId=7), u'```\n%s\n```' % slowText)
+            self.assertEqual(markupTranslator.timedOutTicketIds, [7])
+            self.assertEqual(markupTranslator.translate(u'see ticket:3', ticketId=8), u'see issue #5')
+            self.assertEqual(markupTranslator.translate(u'see ticket:4', ticketId=8), u'see ticket:4')
+            self.assertRaises(TypeError, markupTranslator.translate, None, ticketId=8)
+            self.assertEqual(markupTranslator.translateTitle(slowText, ticketId=9), slowText)
+            self.assertEqual(markupTranslator.timedOutTicketIds, [7, 9])
+        finally:
+            markupTranslator.close()
+
+    def testCanFenceTextWithBackticks(self):
+        self.assertEqual(translator._fenced(u'x'), u'```\nx\n```')
+        self.assertEqual(translator._fenced(u'a ``` b `'), u'````\na ``` b `\n````')
+
+    def testCanLinkSubversionRevisions(self):
+        markupTranslator = translator.Translator('https://github.com/me/mytool', {1: 1},
+                revisionsToCommits={123: '0123abc', 7: '89abcdef'})
+        self.assertEqual(markupTranslator.translate(u'Fixed in r123 and [changeset:7], see changeset:123.'),
+                u'Fixed in [r123](https://github.com/me/mytool/commit/0123abc) and '
+                u'[r7](https://github.com/me/mytool/commit/89abcdef), see '
+                u'[r123](https://github.com/me/mytool/commit/0123abc).')
+        self.assertEqual(markupTranslator.translate(u'[123] but not r8, [8], http://svn/r123 or r2d2'),
+                u'[r123](https://github.com/me/mytool/commit/0123abc) but not r8, [8], http://svn/r123 or r2d2')
+        self.assertEqual(markupTranslator.translate(u'[http://example.com/ 123] and [123](http://example.com/)'),
+                u'[123](http://example.com/) and [123](http://example.com/)')
+        self.assertEqual(markupTranslator.translate(u'Use {{{ x = a[123] }}}, `b[123]` or\n{{{\nr123\n}}}\n'),
+                u'Use ` x = a[123] `, `b[123]` or\n```\nr123\n```\n')
+        self.assertEqual(markupTranslator.translate(u'Windows 2008 r123 and a[123]'), u'Windows 2008 r123 and a[123]')
+
+    def testCanTranslateRandomMarkup(self):
+        markupTranslator = translator.Translator('https://github.com/me/mytool', {1: 1}, trac_url='http://trac',
+                attachmentsPrefix='http://trac/raw-attachment/ticket')
+        fuzz_translator.fuzz(markupTranslator, textCount=200)
+
+
+class EstimateTest(_TempFolderTest):
+    def testCanEstimateApiCalls(self):
+        ticketsCsvPath = _writeTicketsCsv(self.tempFolder, [1, 2, 3])
+        commentsCsvPath = os.path.join(self.tempFolder, 'comments.csv')
+        with open(commentsCsvPath, 'wb') as commentsCsvFile:
+            commentsCsvFile.write('ticket,time,author,newvalue\r\n'
+                    '2,1425000000,alice,See ticket:3\r\n2,1425000100,carl,Fixed.\r\n')
+        callsByToken = tratihubis.estimateApiCalls(ticketsCsvPath, 'T', commentsCsvPath,
+                labelMapping='type=defect: bug', userMapping='alice: TA, *: *', addComponentLabels=True,
+                twoPhaseReferences=True)
+        self.assertEqual(callsByToken['T'], collections.Counter(issues=3, comments=1, labels=2))
+        # Alice owns all tickets, so she applies the labels.
+        self.assertEqual(callsByToken['TA'], collections.Counter(comments=1, edits=4))
+
+    def testCanForecastDuration(self):
+        callsByToken = {'T': collections.Counter(issues=1000), 'TA': collections.Counter(comments=10)}
+        seconds, secondsByToken = tratihubis._forecastSeconds(callsByToken)
+        self.assertEqual(secondsByToken['T'], 2 * 3600.0)
+        self.assertEqual(seconds, 2 * 3600.0)
+
+
+class TokenPoolTest(unittest.TestCase):
+    def testCanPickTokenWithMostRemainingRequests(self):
+        remainingRequests = {'T': 100, 'TB': 4000, 'TC': 4000}
+        createCounts = {'T': 0, 'TB': 7, 'TC': 3}
+        tokenPool = tratihubis._TokenPool(['T', 'TB', 'TC'], createCounts.get, remainingRequests.get)
+        self.assertEqual(tokenPool.nextToken(), 'TC')
+
+    def testCanUsePoolOnlyForUnmappedUsers(self):
+        tracToGithubUserMap = tratihubis._createTracToGithubUserMap(None, 'alice: TA, *: *', 'T')
+        createCounts = {}
+
+        def createCountFor(token):
+            return createCounts.get(token, 0)
+
+        tokenPool = tratihubis._createTokenPool(tracToGithubUserMap, ['TB'], createCountFor)
+        self.assertEqual(tokenPool.tokens, ['T', 'TB'])
+        tokens = []
+        for _ in range(4):
+            token = tratihubis._tokenFor(None, tracToGithubUserMap, 'bob', False, tokenPool)
+            createCounts[token] = createCountFor(token) + 1
+            tokens.append(token)
+        self.assertEqual(sorted(tokens), ['T', 'T', 'TB', 'TB'])
+        self.assertEqual(tratihubis._tokenFor(None, tracToGithubUserMap, 'alice', False, tokenPool), 'TA')
+        self.assertEqual(tratihubis._createTokenPool(tracToGithubUserMap, [], createCountFor), None)
+
+
+class MigrationSessionTest(unittest.TestCase):
+    def setUp(self):
+        tratihubis._setUpdate(False)
+        tratihubis._defaultSession = tratihubis.MigrationSession()
+
+    def testCanEvictLeastRecentlyUsedItems(self):
+        cache = tratihubis._LruCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 0), 0)
+
+    def testCanCacheIssuesPerSession(self):
+        repo = _FakeObject(get_issue=lambda issueNumber: _FakeObject(number=issueNumber))
+        issue = tratihubis._getIssueFromRepo(repo, 1)
+        with tratihubis.MigrationSession(maxIssues=1) as session:
+            self.assertTrue(tratihubis._session() is session)
+            otherIssue = tratihubis._getIssueFromRepo(repo, 1)
+            self.assertFalse(otherIssue is issue)
+            self.assertTrue(tratihubis._getIssueFromRepo(repo, 1) is otherIssue)
+            tratihubis._getIssueFromRepo(repo, 2)
+            self.assertFalse(tratihubis._getIssueFromRepo(repo, 1) is otherIssue)
+        self.assertTrue(tratihubis._session() is not session)
+        self.assertTrue(tratihubis._getIssueFromRepo(repo, 1) is issue)
+
+    def testCanCacheLabelsPerRepo(self):
+        repo = _FakeObject(full_name='me/mytool', get_labels=lambda: [_FakeObject(name='bug')])
+        otherRepo = _FakeObject(full_name='me/other', get_labels=lambda: [_FakeObject(name='defect')])
+        self.assertEqual(tratihubis._repoLabels(repo).keys(), ['bug'])
+        self.assertEqual(tratihubis._repoLabels(otherRepo).keys(), ['defect'])
+        self.assertTrue(tratihubis._repoLabels(repo) is tratihubis._repoLabels(repo))
+
+    def testCanTrackProgress(self):
+        session = tratihubis.MigrationSession()
+        session.countCreates('T')
+        session.countCreates('T', 2)
+        session.addCreatedIssue(3)
+        session.addCreatedIssue(5)
+        self.assertEqual(session.createsOf('T'), 3)
+        self.assertEqual(session.createsOf('TB'), 0)
+        self.assertEqual((session.createdIssueCount, session.lastCreatedIssue), (2, 5))
+
+
+class PhaseProfilerTest(unittest.TestCase):
+    def testCanReportPhases(self):
+        phaseProfiler = tratihubis._PhaseProfiler()
+        phaseProfiler.enter(u'read config')
+        phaseProfiler.enter(u'convert tickets')
+        phaseProfiler.enter(u'read config')
+        phaseProfiler.leave()
+        self.assertEqual(phaseProfiler.phases.keys(), [u'read config', u'convert tickets'])
+        report = phaseProfiler.report()
+        self.assertTrue(report[1].startswith(u'read config '))
+        self.assertTrue(report[3].startswith(u'total '))
+
+    def testCanIgnorePhases(self):
+        phaseProfiler = tratihubis._NullPhaseProfiler()
+        phaseProfiler.enter(u'read config')
+        self.assertEqual(phaseProfiler.report(), [])
+
+    def testCanParseProfileOptions(self):
+        options, command, configPath = tratihubis._parsedOptions(
+                ['--profile', '--profileDump', 'tratihubis.prof', 'render', 'tratihubis.cfg'])
+        self.assertTrue(options.profile)
+        self.assertEqual(options.profileDump, 'tratihubis.prof')
+        self.assertEqual(command, 'render')
+
+
+class FoldCommentsTest(unittest.TestCase):
+    def testCanDecideToFoldComments(self):
+        oldClosedTicketMap = {'status': 'closed', 'modifiedtime': datetime.datetime(2010, 1, 1)}
+        newOpenTicketMap = {'status': 'new', 'modifiedtime': datetime.datetime(2015, 1, 1)}
+        self.assertFalse(tratihubis._shouldFoldComments(newOpenTicketMap, 200))
+        self.assertTrue(tratihubis._shouldFoldComments(newOpenTicketMap, 200, 100))
+        self.assertFalse(tratihubis._shouldFoldComments(newOpenTicketMap, 100, 100))
+        self.assertTrue(tratihubis._shouldFoldComments(oldClosedTicketMap, 2, 0, datetime.datetime(2012, 1, 1)))
+        self.assertFalse(tratihubis._shouldFoldComments(newOpenTicketMap, 2, 0, datetime.datetime(2012, 1, 1)))
+        self.assertFalse(tratihubis._shouldFoldComments(oldClosedTicketMap, 1, 0, datetime.datetime(2012, 1, 1)))
+
+    def testCanFoldComments(self):
+        separatorLength = len(tratihubis._FOLDED_COMMENT_SEPARATOR)
+        self.assertEqual(tratihubis._foldedComments([u'a' * 10, u'b' * 10, u'c' * 10], 20 + separatorLength),
+                [[0, 1], [2]])
+        self.assertEqual(tratihubis._foldedComments([u'a' * 10, u'b' * 30, u'c' * 10], 25), [[0], [1], [2]])
+        self.assertEqual(tratihubis._foldedComments([]), [])
+
+    def testCanSplitText(self):
+        self.assertEqual(tratihubis._splitText(u'abc\ndef\nghi', 7), [u'abc\n', u'def\nghi'])
+        self.assertEqual(tratihubis._splitText(u'abcdefgh', 3), [u'abc', u'def', u'gh'])
+        self.assertEqual(tratihubis._splitText(u'short'), [u'short'])
+
+    def testFailsOnBrokenFoldCommentsThreshold(self):
+        config = ConfigParser.SafeConfigParser()
+        config.add_section(tratihubis._SECTION)
+        self.assertEqual(tratihubis._getIntConfigOption(config, 'foldCommentsThreshold'), 0)
+        config.set(tratihubis._SECTION, 'foldCommentsThreshold', '50')
+        self.assertEqual(tratihubis._getIntConfigOption(config, 'foldCommentsThreshold'), 50)
+        config.set(tratihubis._SECTION, 'foldCommentsThreshold', 'many')
+        self.assertRaises(tratihubis._ConfigError, tratihubis._getIntConfigOption, config, 'foldCommentsThreshold')
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        self._sleep = tratihubis.time.sleep
+        tratihubis.time.sleep = lambda seconds: None
+
+    def tearDown(self):
+        tratihubis.time.sleep = self._sleep
+
+    def _failingAction(self, errors, result):
+        remainingErrors = list(errors)
+
+        def action():
+            if remainingErrors:
+                raise remainingErrors.pop(0)
+            return result
+        return action
+
+    def testCanDetectTransientErrors(self):
+        self.assertTrue(tratihubis._isTransientError(github.GithubException(502, {'message': 'Bad Gateway'})))
+        self.assertTrue(tratihubis._isTransientError(github.GithubException(403, {
+                'message': 'You have triggered an abuse detection mechanism.'})))
+        self.assertTrue(tratihubis._isTransientError(IOError('connection reset')))
+        self.assertFalse(tratihubis._isTransientError(github.GithubException(403, {'message': 'Forbidden'})))
+        self.assertFalse(tratihubis._isTransientError(github.GithubException(422, {'message': 'Validation Failed'})))
+
+    def testCanRetryTransientErrors(self):
+        action = self._failingAction([github.GithubException(502, {}), IOError('timeout')], 'issue')
+        self.assertEqual(tratihubis._withRetry(action, 'create issue'), 'issue')
+
+    def testFailsOnPermanentError(self):
+        action = self._failingAction([github.GithubException(422, {})], 'issue')
+        self.assertRaises(github.GithubException, tratihubis._withRetry, action, 'create issue')
+
+    def testFailsAfterTooManyRetries(self):
+        action = self._failingAction([github.GithubException(503, {})] * 3, 'issue')
+        self.assertRaises(github.GithubException, tratihubis._withRetry, action, 'create issue', retries=2)
+
+    def testCanUseExistingResultInsteadOfRetry(self):
+        action = self._failingAction([github.GithubException(502, {})], 'duplicate issue')
+        self.assertEqual(tratihubis._withRetry(action, 'create issue', lambda: 'existing issue'), 'existing issue')
+
+    def testCanRetryTransientErrorsWhileLookingForExistingResult(self):
+        action = self._failingAction([github.GithubException(502, {})], 'issue')
+        findExisting = self._failingAction([IOError('connection reset')], None)
+        self.assertEqual(tratihubis._withRetry(action, 'create issue', findExisting), 'issue')
+
+    def testFailsOnPermanentErrorWhileLookingForExistingResult(self):
+        action = self._failingAction([github.GithubException(502, {})], 'issue')
+        findExisting = self._failingAction([github.GithubException(404, {})], None)
+        self.assertRaises(github.GithubException, tratihubis._withRetry, action, 'create issue', findExisting)
+
+    def testCanWaitLongerAfterAbuseDetection(self):
+        abuseError = github.GithubException(403, {'message': 'You have exceeded a secondary rate limit.'})
+        self.assertTrue(tratihubis._isTransientError(abuseError))
+        self.assertTrue(tratihubis._retryDelay(abuseError, 1) >= tratihubis._ABUSE_RETRY_DELAY)
+        self.assertTrue(tratihubis._retryDelay(github.GithubException(502, {}), 1) <= tratihubis._RETRY_BASE_DELAY)
+
+    def testCanFindIssueWithMarkerAmongManyNewIssues(self):
+        marker = tratihubis._idempotencyMarker(17)
+        issues = [_FakeObject(number=number, body=u'other issue') for number in range(100, 50, -1)]
+        issues.append(_FakeObject(number=50, body=u'issue' + marker))
+        since = datetime.datetime(2015, 6, 1)
+        getIssuesArguments = []
+
+        def getIssues(**arguments):
+            getIssuesArguments.append(arguments)
+            return iter(issues)
+        repo = _FakeObject(get_issues=getIssues)
+        self.assertEqual(tratihubis._findIssueWithMarker(repo, marker, since).number, 50)
+        self.assertEqual(getIssuesArguments[0]['since'], since)
+        self.assertEqual(tratihubis._findIssueWithMarker(repo, tratihubis._idempotencyMarker(18), since), None)
+
+    def testCanWaitForRateLimitReset(self):
+        tempFolder = tempfile.mkdtemp(prefix='tratihubis_test_')
+        self.addCleanup(shutil.rmtree, tempFolder)
+        resetTime = int(time.time()) + 600
+        rateLimitHeaders = {'content-type': 'application/json; charset=utf-8', 'x-ratelimit-limit': '5000',
+                            'x-ratelimit-remaining': '0', 'x-ratelimit-reset': str(resetTime)}
+        cassettePath = _writeCassette(tempFolder, [
+            _cassetteInteraction('/repos/me/mytool', {'url': 'https://api.github.com/repos/me/mytool'}),
+            {'method': 'POST', 'url': '/repos/me/mytool/milestones', 'status': 403, 'headers': rateLimitHeaders,
+             'body': json.dumps({'message': 'API rate limit exceeded for user ID 1.'})},
+            _cassetteInteraction('/repos/me/mytool/milestones?state=all', []),
+            {'method': 'POST', 'url': '/repos/me/mytool/milestones', 'status': 201,
+             'headers': {'content-type': 'application/json; charset=utf-8'},
+             'body': json.dumps({'number': 1, 'title': '1.0'})},
+        ])
+        sleeps = []
+        tratihubis.time.sleep = sleeps.append
+        cassette = github_cassette.Cassette(cassettePath)
+        cassette.start()
+        try:
+            repo = github.Github().get_repo('me/mytool')
+            milestone = tratihubis._createMilestone(repo, '1.0')
+        finally:
+            cassette.stop()
+        self.assertEqual(milestone.number, 1)
+        self.assertEqual(len(sleeps), 1)
+        self.assertTrue(590 < sleeps[0] <= 601, sleeps)
+        self.assertEqual(cassette.unusedInteractions(), [])
+
+    def testCanComputeIdempotencyMarker(self):
+        self.assertEqual(tratihubis._idempotencyMarker(17), u'\n<!-- tratihubis:ticket=17 -->')
+        self.assertEqual(tratihubis._idempotencyMarker(17, 'comment', 3),
+                u'\n<!-- tratihubis:ticket=17:comment=3 -->')
 
 
 if __name__ == "__main__":
@@ -1,66 +1,86 @@
+import multiprocessing
 import re
+import time
+
+# Any reference to a ticket, regardless of whether a rule below turns it into a link.
+_TICKET_REFERENCE_PATTERN = re.compile(r"ticket:([0-9]{1,5})")
+
+# Rules referring to attachments of the current ticket, their replacement with placeholders for the
+# attachments prefix and ticket id, and the literals any text matching them has to contain.
+_TICKET_SUBS = [
+    [re.compile(r"\[\[Image\((\S*?)\,\s{0,}\S*?\)\]\]", re.DOTALL), r"![\1]({attachmentsPrefix}/{ticketId}/\1)", ('[[Image(',)],
+    [re.compile(r"\[\[Image\((\S*?)\)\]\]", re.DOTALL), r"![\1]({attachmentsPrefix}/{ticketId}/\1)", ('[[Image(',)],
+    [re.compile(r"attachment:(\S*?)", re.DOTALL), r"{attachmentsPrefix}/{ticketId}/\1", ('attachment:',)],
+]
 
 class Translator(object):
     """
     Simple regular expressions to convert Trac wiki to Github markdown.
     """
-    def __init__(self, repo, ticketsToIssuesMap, trac_url=None, attachmentsPrefix=None):
-        if isinstance(repo, str):
+    def __init__(self, repo, ticketsToIssuesMap, trac_url=None, attachmentsPrefix=None, profile=False,
+                 revisionsToCommits=None):
+        if isinstance(repo, basestring):
             self.repo_url = repo
         else:
             self.repo_url = r'https://github.com/{login}/{name}'.format(login=repo.owner.login, name=repo.name)
         self.trac_url = trac_url
         self.ticketsToIssuesMap = ticketsToIssuesMap
+        # Anything with a get(revision) returning the git commit of a Subversion revision, or None.
+        self.revisionsToCommits = revisionsToCommits
         self.subs = self.compile_subs()
         self.attachmentsPrefix = attachmentsPrefix
+        # Seconds, texts changed and substitutions made by each rule if profiling is enabled.
+        self.profile = {} if profile else None
+        # Tickets with texts that took too long to translate and have been passed on unchanged.
+        self.timedOutTicketIds = []
 
     def compile_subs(self):
         subs = [
             # This first handles things like #!xml
-            [r"\{\{\{\s*?[\n\r]{1,2}#!([a-z\/]+)(.*?)\}\}\}", r"```\1\2```"],
+            [r"\{\{\{\s*?[\n\r]{1,2}#!([a-z\/]+)(.*?)\}\}\}", r"```\1\2```", ('{{{',)],
             # Single line block quotes
-            [r"\{\{\{([^\n]*?)\}\}\}",  r"`\1`"],
+            [r"\{\{\{([^\n]*?)\}\}\}",  r"`\1`", ('{{{',)],
             # Multi line block quotes
-            [r"\{\{\{(.*?)\}\}\}",  r"```\1```"],
+            [r"\{\{\{(.*?)\}\}\}",  r"```\1```", ('{{{',)],
             # These next are for headings
-            [r"====\s([^\n]+?)\s====(\s*[\n\r]+)", r'#### \1\2'],
-            [r"===\s([^\n]+?)\s===(\s*[\n\r]+)", r'### \1\2'],
-            [r"==\s([^\n]+?)\s==(\s*[\n\r]+)", r'## \1\2'],
-            [r"=\s([^\n]+?)\s=(\s*[\n\r]+)", r'# \1\2'],
-            [r"\!(([A-Z][a-z0-9]+){2,})", r'\1'],
+            [r"====\s([^\n]+?)\s====(\s*[\n\r]+)", r'#### \1\2', ('====',)],
+            [r"===\s([^\n]+?)\s===(\s*[\n\r]+)", r'### \1\2', ('===',)],
+            [r"==\s([^\n]+?)\s==(\s*[\n\r]+)", r'## \1\2', ('==',)],
+            [r"=\s([^\n]+?)\s=(\s*[\n\r]+)", r'# \1\2', ('=',)],
+            [r"\!(([A-Z][a-z0-9]+){2,})", r'\1', ('!',)],
             # These next are italics, bold
-            [r"'''(.+)'''", r'*\1*'],
-            [r"''(.+)''", r'_\1_'],
+            [r"'''(.+)'''", r'*\1*', ("'''",)],
+            [r"''(.+)''", r'_\1_', ("''",)],
             # This was an attempt to avoid converting things that shouldnt, but not quite there yet
 #            [r"'''([^\]\'\s\n\,\}\=].*[^\]\'\s\n\,\}\=])'''", r'*\1*'],
 #            [r"''([^\]\'\s\n\,\}\=](?!\'\').*(?!\'\')[^\]\'\s\n\,\}\=])''", r'_\1_'],
             # These next 2 are various bulleted or numbered lists
             # This next should probably be beginning-of-line, not beginning-of-field
             # So need to give the MULTILINE, M flag re.M. Or change ^ to \n
-            [r"^\s\*", r'*'],
+            [r"^\s\*", r'*', ('*',)],
             # Hmm. This next rule turns any #d list at start of field into a header. That makes no sense
             # Probably '\s\d.\s' changed to '\d.\s' is better
 #            [r"^\s\d\.", r'#'],
             # This next looks like it tries to strip leading !, getting rid of wikilink escapes
-            [r"!(\w)", r"\1"],
+            [r"!(\w)", r"\1", ('!',)],
             #            [r"(^|\n)[ ]{6,}", r"\1"], # AH: This stripped leading whitespace from lines, which messes up block quotes
 #            [r"\[([^\s\n\,\]\.\(\)]{6,}?)\s{1,}([^\n]+?)\]", r"[\2](\1)"],
             # This next line turns hashes into links. Require at least 15 chars to avoid mistaken links
-            [r"(\s+|\()(changeset:|commit:|:)?([0-9a-f]{15,})([^0-9a-f\-])", r"\1[\3]({repo_url}/commit/\3)\4".format(repo_url=self.repo_url)],
-            [r"source:branches/([\w\-]*)", r"[\1](../tree/\1)"],
-            [r"source:fipy/([\w/\.]*)@([0-9a-f]{5,40})", r"[\1@\2](../tree/\2/\1)"],
-            [r"source:([\w/\.\-\_\d\~]+)", r"[\1](../tree/master/\1)"],
-            [r"blog:(\w*)", r"[blog:\1]({trac_url}/blog/\1)".format(trac_url=self.trac_url)],
-            [r"(\b)([0-9a-f]{5,40})\.", r"\1\2"],
-            [r" (\w*?)::[\s\n\r]+", r"####\n \1"], # Is this meant for a definition list?
+            [r"(\s+|\()(changeset:|commit:|:)?([0-9a-f]{15,})([^0-9a-f\-])", r"\1[\3]({repo_url}/commit/\3)\4".format(repo_url=self.repo_url), None],
+            [r"source:branches/([\w\-]*)", r"[\1](../tree/\1)", ('source:branches/',)],
+            [r"source:fipy/([\w/\.]*)@([0-9a-f]{5,40})", r"[\1@\2](../tree/\2/\1)", ('source:fipy/',)],
+            [r"source:([\w/\.\-\_\d\~]+)", r"[\1](../tree/master/\1)", ('source:',)],
+            [r"blog:(\w*)", r"[blog:\1]({trac_url}/blog/\1)".format(trac_url=self.trac_url), ('blog:',)],
+            [r"(\b)([0-9a-f]{5,40})\.", r"\1\2", ('.',)],
+            [r" (\w*?)::[\s\n\r]+", r"####\n \1", ('::',)], # Is this meant for a definition list?
             # I cannot figure out what this next one is used for, in that I cannot find a link like this
             # [r"\[([0-9]{1,4})\/(.+?)\]", r"[\1/\2]({trac_url}/changeset/\1/historical/\2)".format(trac_url=self.trac_url)],
-            [r'\[changeset:"(\S*?)\/fipy"\]', r"\1"],          
-            [r'\^([0-9]{1,5})\^', r"<sup>\1</sup>"],
-            [r'diff:@([0-9]{1,5}):([0-9]{1,5})', r'[diff:@\1:\2]({trac_url}/changeset?new=\2&old=\1)'.format(trac_url=self.trac_url)],
+            [r'\[changeset:"(\S*?)\/fipy"\]', r"\1", ('[changeset:"',)],          
+            [r'\^([0-9]{1,5})\^', r"<sup>\1</sup>", ('^',)],
+            [r'diff:@([0-9]{1,5}):([0-9]{1,5})', r'[diff:@\1:\2]({trac_url}/changeset?new=\2&old=\1)'.format(trac_url=self.trac_url), ('diff:@',)],
             #[r"\[([^\[\]\s\n\r\E\"\{][^\[\]\s\n\r\"\{]+)\s+([^\]]+)]", r"[\2](\1)"]
             # Try to exclude things that are used in apache error logs or access logs
-            [r"\[(?!Thu|Mon|Tue|Wed|Fri|Sat|Sun|client|Last|Native|\d\d\/)([^\]\[\{E\s\n\r\t\"\'][^\]\[\{\s\n\r\"\'\t]+)\s+([^\]]+)]", r"[\2](\1)"]
+            [r"\[(?!Thu|Mon|Tue|Wed|Fri|Sat|Sun|client|Last|Native|\d\d\/)([^\]\[\{E\s\n\r\t\"\'][^\]\[\{\s\n\r\"\'\t]+)\s+([^\]]+)]", r"[\2](\1)", ('[',)]
             ]
 
         # Last one converts wiki links [URL text] to markdown links [text](URL)
@@ -68,49 +88,223 @@ class Translator(object):
         # have certain characters
 
         if self.ticketsToIssuesMap:
+            # References to tickets without an issue, for example because they have not been imported yet,
+            # are left as they are.
             # This one handles links to tickets not inside square brackets
             # ticket:123
             # or
             #   (ticket:123)
             # becomes: issue #123
             regex = r"(\s|[^\]]\()ticket:([0-9]{1,5})"
-            sub = lambda m: r"{0}issue #{1}".format(m.group(1), self.ticketsToIssuesMap[int(m.group(2))])
-            subs.append([regex, sub])
+            sub = lambda m: self._ticketLink(m, 2, r"{0}issue #{1}".format, m.group(1))
+            subs.append([regex, sub, ('ticket:',)])
             # Handle something like [linkname](ticket:123): Make it [linkname](123)
             regex = r"(\]\()ticket:([0-9]{1,4})"
-            sub = lambda m: r"{0}{1}".format(m.group(1), self.ticketsToIssuesMap[int(m.group(2))])
-            subs.append([regex, sub])
+            sub = lambda m: self._ticketLink(m, 2, r"{0}{1}".format, m.group(1))
+            subs.append([regex, sub, ('](ticket:',)])
             # This one handles links to tickets inside square brackets: [ticket:123], making it [http://github.com/owner/repo/issues/123]
             regex = r"\[ticket:([0-9]{1,4})\]"
-            sub = lambda m: r"\[{repo_url}/issues/{0}\]".format(self.ticketsToIssuesMap[int(m.group(1))], repo_url=self.repo_url)
-            subs.append([regex, sub])
+            sub = lambda m: self._ticketLink(m, 1, r"\[{0}/issues/{1}\]".format, self.repo_url)
+            subs.append([regex, sub, ('[ticket:',)])
+
+        if self.revisionsToCommits is not None:
+            # Links to Subversion revisions: [changeset:123], changeset:123, [123] and r123. Revisions without a
+            # git commit are left as they are, and so is code, which the first two alternatives match. Like Trac,
+            # an unclosed {{{ is taken as code until the end of the text. This runs before all other rules so it
+            # does not mistake their links like [42](http://...) for revisions.
+            regex = (r"(\{\{\{.*?(?:\}\}\}|\Z)|`[^`\n]*`)"
+                     r"|\[changeset:([0-9]+)\]|changeset:([0-9]+)\b"
+                     r"|(?<!\w)\[([0-9]+)\](?![(\[])"
+                     r"|(?<![\w/.\-])(?<![0-9] )r([0-9]+)\b")
+            subs.insert(0, [regex, self._revisionLink, None])
+
+        return [[re.compile(r, re.DOTALL), s, triggers] for r, s, triggers in subs]
+
+    def _revisionLink(self, match):
+        if match.group(1) is not None:
+            return match.group(0)
+        revision = next(group for group in match.groups()[1:] if group is not None)
+        commit = self.revisionsToCommits.get(int(revision))
+        if commit is None:
+            return match.group(0)
+        return u"[r{0}]({1}/commit/{2})".format(revision, self.repo_url, commit)
 
-        return [[re.compile(r, re.DOTALL), s] for r, s in subs]
+    def _ticketLink(self, match, ticketGroup, format, prefix):
+        """
+        ``format(prefix, issueNumber)`` for the ticket in group ``ticketGroup`` of ``match``, or the text matched
+        if the ticket has no issue.
+        """
+        try:
+            issueNumber = self.ticketsToIssuesMap[int(match.group(ticketGroup))]
+        except KeyError:
+            return match.group(0)
+        return format(prefix, issueNumber)
 
     def no_compile_subs(self, ticketId):
-        #print 'ticketId',ticketId
-        subs = [[r"\[\[Image\((\S*?)\,\s{0,}\S*?\)\]\]", r"![\1]({attachmentsPrefix}/{ticketId}/\1)".format(attachmentsPrefix=self.attachmentsPrefix, ticketId=ticketId)],
-                [r"\[\[Image\((\S*?)\)\]\]", r"![\1]({attachmentsPrefix}/{ticketId}/\1)".format(attachmentsPrefix=self.attachmentsPrefix, ticketId=ticketId)],
-                [r"attachment:(\S*?)", r"{attachmentsPrefix}/{ticketId}/\1".format(attachmentsPrefix=self.attachmentsPrefix, ticketId=ticketId)]]
+        """
+        Rules for the attachments of ``ticketId`` using the patterns compiled once in `_TICKET_SUBS`.
+        """
+        return [[p, s.format(attachmentsPrefix=self.attachmentsPrefix, ticketId=ticketId), triggers]
+                for p, s, triggers in _TICKET_SUBS]
 
-        return subs
+
+    def referencedTickets(self, text):
+        """
+        Set of ticket ids referred to in ``text`` as ``ticket:N``.
+        """
+        return set(int(ticketId) for ticketId in _TICKET_REFERENCE_PATTERN.findall(text))
 
     def translate(self, text, ticketId=''):
         if ticketId and ticketId != '':
-            subs = self.no_compile_subs(ticketId)
-            for r, s in subs:
-                p = re.compile(r, re.DOTALL)
-                #ot = text
-                text = p.sub(s, text)
-                #if ot != text:
-                #    print "regex '%s' changed \n'%s' to \n'%s'" % (r, ot, text)
-        for p, s in self.subs:
-            #ot = text
-            text = p.sub(s, text)
-            #if ot != text:
-            #    print "regex '%s' changed \n'%s' to \n'%s'" % (p.pattern, ot, text)
+            subs = self.no_compile_subs(ticketId) + self.subs
+        else:
+            subs = self.subs
+        for p, s, triggers in subs:
+            # Skip rules that cannot match because none of their trigger literals occur in the text as changed
+            # by the previous rules. A substring test is much cheaper than a failing regular expression search.
+            if (triggers is None) or any(literal in text for literal in triggers):
+                if self.profile is None:
+                    text = p.sub(s, text)
+                else:
+                    text = self._profiledSub(p, s, text)
         return text
 
+    def translateTitle(self, text, ticketId=''):
+        """
+        Like `translate()` but for the title of ``ticketId``, which the rules for attachments do not apply to.
+        """
+        return self.translate(text)
+
+    def _profiledSub(self, p, s, text):
+        startTime = time.time()
+        newText, substitutionCount = p.subn(s, text)
+        seconds, changedCount, totalSubstitutionCount = self.profile.get(p.pattern, (0.0, 0, 0))
+        self.profile[p.pattern] = (
+            seconds + time.time() - startTime,
+            changedCount + (1 if newText != text else 0),
+            totalSubstitutionCount + substitutionCount)
+        return newText
+
+    def profileReport(self):
+        """
+        Lines describing the time and hits of each rule applied so far, most expensive first.
+        """
+        result = []
+        if self.profile:
+            for pattern, (seconds, changedCount, substitutionCount) in sorted(
+                    self.profile.items(), key=lambda item: item[1][0], reverse=True):
+                result.append(u'%8.3fs %6d texts %7d hits: %s' % (seconds, changedCount, substitutionCount, pattern))
+        return result
+
+    def close(self):
+        pass
+
+
+def _translateInWorker(connection, translatorArguments, profile, revisionsToCommits=None):
+    """
+    Translate the ``(text, ticketId)`` received from ``connection`` until receiving `None`.
+    """
+    translator = Translator(*translatorArguments, profile=profile, revisionsToCommits=revisionsToCommits)
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        text, ticketId = request
+        if profile:
+            translator.profile = {}
+        try:
+            connection.send((translator.translate(text, ticketId), translator.profile, None))
+        except Exception, error:
+            connection.send((None, None, error))
+
+
+def _fenced(text):
+    """
+    ``text`` as code block with a fence longer than any sequence of backticks in it.
+    """
+    backtickCount = max([len(backticks) for backticks in re.findall(r'`+', text)] or [0])
+    fence = u'`' * max(3, backtickCount + 1)
+    return u'%s\n%s\n%s' % (fence, text, fence)
+
+
+class TimeLimitedTranslator(Translator):
+    """
+    Translator that applies its rules in a separate process, which is stopped and restarted once translating a
+    text takes longer than ``timeLimit`` seconds. Such a text is passed on as it is (``fallback='raw'``) or as
+    code block (``fallback='fenced'``), and the ticket it belongs to is added to ``timedOutTicketIds``.
+
+    Regular expressions cannot be interrupted within the same process, so this is the only way to prevent one
+    pathological text from blocking the conversion for minutes.
+    """
+    def __init__(self, repo, ticketsToIssuesMap, trac_url=None, attachmentsPrefix=None, profile=False,
+                 revisionsToCommits=None, timeLimit=10, fallback='raw'):
+        assert timeLimit > 0
+        assert fallback in ('raw', 'fenced')
+        super(TimeLimitedTranslator, self).__init__(repo, ticketsToIssuesMap, trac_url, attachmentsPrefix, profile,
+                                                    revisionsToCommits)
+        self.timeLimit = timeLimit
+        self.fallback = fallback
+        self._translatorArguments = (self.repo_url, ticketsToIssuesMap, trac_url, attachmentsPrefix)
+        self._connection = None
+        self._worker = None
+
+    def _startWorker(self):
+        self._connection, workerConnection = multiprocessing.Pipe()
+        self._worker = multiprocessing.Process(target=_translateInWorker,
+                args=(workerConnection, self._translatorArguments, self.profile is not None,
+                      self.revisionsToCommits))
+        self._worker.daemon = True
+        self._worker.start()
+        workerConnection.close()
+
+    def _stopWorker(self):
+        self._worker.terminate()
+        self._worker.join()
+        self._connection.close()
+        self._worker = None
+        self._connection = None
+
+    def translate(self, text, ticketId=''):
+        return self._translatedInWorker(text, ticketId, ticketId, self.fallback)
+
+    def translateTitle(self, text, ticketId=''):
+        # A title is a single line of plain text, so it cannot be fenced.
+        return self._translatedInWorker(text, '', ticketId, 'raw')
+
+    def _translatedInWorker(self, text, rulesTicketId, ticketId, fallback):
+        if self._worker is None:
+            self._startWorker()
+        self._connection.send((text, rulesTicketId))
+        if not self._connection.poll(self.timeLimit):
+            self._stopWorker()
+            self.timedOutTicketIds.append(ticketId)
+            if fallback == 'fenced':
+                text = _fenced(text)
+            return text
+        translatedText, profile, error = self._connection.recv()
+        if error is not None:
+            raise error
+        if profile:
+            for pattern, (seconds, changedCount, substitutionCount) in profile.items():
+                totalSeconds, totalChangedCount, totalSubstitutionCount = self.profile.get(pattern, (0.0, 0, 0))
+                self.profile[pattern] = (
+                    totalSeconds + seconds,
+                    totalChangedCount + changedCount,
+                    totalSubstitutionCount + substitutionCount)
+        return translatedText
+
+    def close(self):
+        if self._worker is not None:
+            self._connection.send(None)
+            self._worker.join()
+            self._connection.close()
+            self._worker = None
+            self._connection = None
+
+
 class NullTranslator(Translator):
-    def translate(self, text):
+    def translate(self, text, ticketId=''):
         return text